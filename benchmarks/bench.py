@@ -0,0 +1,186 @@
+"""
+Times the pipeline on synthetic inputs at several scales.
+
+The stages of process_worldwide.py are measured in-process (wall time and
+peak traced memory). Every script is also run end to end in a subprocess
+against a pre-filled offline download cache (wall time and peak RSS).
+
+    python benchmarks/bench.py --scales small medium --json report.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(repo, "scripts"))
+
+import fetch  # noqa: E402
+import synthetic  # noqa: E402
+from output import write_csv  # noqa: E402
+from process_worldwide import WorldwidePipeline  # noqa: E402
+
+scales = {
+    "small": dict(days=100, countries=50, counties=300, rki_rows=20000),
+    "medium": dict(days=400, countries=190, counties=1000, rki_rows=200000),
+    "large": dict(days=1100, countries=200, counties=3300, rki_rows=1000000),
+}
+scripts = ["process_worldwide.py", "process_us.py", "plot.py", "plot_rki.py"]
+
+
+def measure(results, scale, stage, func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    wall = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results.append(
+        {"scale": scale, "stage": stage, "wall_s": wall, "peak_mb": peak / 1e6}
+    )
+    return result
+
+
+def write_inputs(directory, size):
+    # synthetic upstream files, stored under their real urls in an offline
+    # download cache
+    world = synthetic.global_tables(size["countries"], size["days"])
+    us = synthetic.us_tables(size["counties"], size["days"])
+    frames = {
+        "confirmed_global": world["confirmed"],
+        "deaths_global": world["dead"],
+        "recovered_global": world["recovered"],
+        "confirmed_us": us["confirmed"],
+        "deaths_us": us["dead"],
+        "reference": us["reference"],
+        "combined": WorldwidePipeline(**world).time_series,
+        "rki": synthetic.rki_line_list(size["rki_rows"], size["days"]),
+    }
+    cache_dir = os.path.join(directory, "cache")
+    os.makedirs(cache_dir)
+    for name, df in frames.items():
+        url = fetch.sources[name]
+        data_path, meta_path = fetch.cache_paths(url, cache_dir)
+        df.to_csv(data_path, index=False)
+        with open(meta_path, "w") as fp:
+            json.dump({"url": url}, fp)
+    return cache_dir, world
+
+
+def bench_worldwide(results, scale, directory, world):
+    paths = {}
+    for name, df in world.items():
+        paths[name] = os.path.join(directory, f"{name}.csv")
+        df.to_csv(paths[name], index=False)
+
+    tables = measure(
+        results,
+        scale,
+        "worldwide: parse",
+        lambda: {name: pd.read_csv(path) for name, path in paths.items()},
+    )
+    pipeline = WorldwidePipeline(**tables)
+    for stage in [
+        "countries",
+        "countries_aggregated",
+        "time_series",
+        "key_countries",
+        "world_aggregate",
+    ]:
+        measure(
+            results,
+            scale,
+            f"worldwide: {stage}",
+            lambda: getattr(pipeline, stage),
+        )
+    measure(
+        results,
+        scale,
+        "worldwide: write",
+        lambda: [
+            write_csv(df, os.path.join(directory, f"out{i}.csv"))
+            for i, df in enumerate(
+                [
+                    pipeline.countries_aggregated,
+                    pipeline.time_series,
+                    pipeline.key_countries,
+                    pipeline.world_aggregate,
+                ]
+            )
+        ],
+    )
+
+
+def run_script(results, scale, directory, cache_dir, script):
+    # the processors write to data/, the plots to ../docs/plots
+    cwd = (
+        directory
+        if script.startswith("process")
+        else os.path.join(directory, "scripts")
+    )
+    env = dict(os.environ, COVID_CACHE_DIR=cache_dir, COVID_OFFLINE="1")
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(repo, "scripts", script)],
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    ok = status == 0
+    if not ok:
+        print(f"{script} failed:\n{stderr.decode()[-2000:]}")
+    results.append(
+        {
+            "scale": scale,
+            "stage": f"script: {script}",
+            "wall_s": wall,
+            # ru_maxrss is in kilobytes on linux
+            "peak_mb": usage.ru_maxrss / 1e3,
+            "ok": ok,
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--scales", nargs="+", default=["small"], choices=list(scales)
+    )
+    parser.add_argument("--scripts", nargs="*", default=scripts)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory() as directory:
+            for sub in ["data", "scripts", "docs/plots"]:
+                os.makedirs(os.path.join(directory, sub))
+            cache_dir, world = write_inputs(directory, scales[scale])
+            bench_worldwide(results, scale, directory, world)
+            for script in args.scripts:
+                run_script(results, scale, directory, cache_dir, script)
+
+    print(f"{'scale':8} {'stage':40} {'wall [s]':>10} {'peak [MB]':>10}")
+    for r in results:
+        print(
+            f"{r['scale']:8} {r['stage']:40} "
+            f"{r['wall_s']:10.3f} {r['peak_mb']:10.1f}"
+        )
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Synthetic inputs in the shapes of the upstream sources (JHU global and US
+time series, UID lookup table, RKI line list), so the pipeline can be
+measured without network access.
+"""
+
+import datetime
+
+import numpy as np
+import pandas as pd
+
+# real names first, the scripts look some of them up
+country_names = [
+    "Austria",
+    "Belgium",
+    "Brazil",
+    "China",
+    "Denmark",
+    "Egypt",
+    "France",
+    "Germany",
+    "India",
+    "Iran",
+    "Israel",
+    "Italy",
+    "Korea, South",
+    "Poland",
+    "Russia",
+    "South Africa",
+    "Spain",
+    "Sweden",
+    "Switzerland",
+    "US",
+    "United Kingdom",
+]
+age_groups = [
+    "A00-A04",
+    "A05-A14",
+    "A15-A34",
+    "A35-A59",
+    "A60-A79",
+    "A80+",
+    "unbekannt",
+]
+
+
+def days(n_days):
+    start = datetime.date(2020, 1, 22)
+    return [start + datetime.timedelta(i) for i in range(n_days)]
+
+
+def date_headers(n_days):
+    # JHU style "m/d/yy"
+    return [f"{d.month}/{d.day}/{d:%y}" for d in days(n_days)]
+
+
+def cumulative(rng, n_rows, n_days, scale=50):
+    return np.cumsum(rng.integers(0, scale, (n_rows, n_days)), axis=1)
+
+
+def global_tables(n_countries, n_days, n_split=10, n_provinces=5, seed=0):
+    # JHU global confirmed/deaths/recovered: n_split of the countries are
+    # reported per province; like Canada, the first split country has no
+    # province rows in recovered but a single country row.
+    rng = np.random.default_rng(seed)
+    names = country_names + [
+        f"Country {i}" for i in range(len(country_names), n_countries)
+    ]
+    rows = []
+    for i, country in enumerate(names[:n_countries]):
+        if i < n_split:
+            rows += [(f"Province {j}", country) for j in range(n_provinces)]
+        else:
+            rows.append((np.nan, country))
+    locations = pd.DataFrame(
+        rows, columns=["Province/State", "Country/Region"]
+    )
+    locations["Lat"] = rng.uniform(-60, 60, len(rows))
+    locations["Long"] = rng.uniform(-180, 180, len(rows))
+    headers = date_headers(n_days)
+
+    def table(df, scale):
+        values = pd.DataFrame(
+            cumulative(rng, len(df), n_days, scale), columns=headers
+        )
+        return pd.concat([df.reset_index(drop=True), values], axis=1)
+
+    split = locations["Country/Region"] == names[0]
+    recovered = pd.concat(
+        [
+            locations[~split],
+            pd.DataFrame(
+                {"Province/State": [np.nan], "Country/Region": [names[0]]}
+            ),
+        ]
+    )
+    recovered[["Lat", "Long"]] = recovered[["Lat", "Long"]].fillna(0.0)
+    return {
+        "confirmed": table(locations, 50),
+        "dead": table(locations, 2),
+        "recovered": table(recovered, 40),
+    }
+
+
+def us_tables(n_counties, n_days, n_states=50, seed=0):
+    # JHU US confirmed/deaths plus the matching UID lookup table
+    rng = np.random.default_rng(seed)
+    ids = np.arange(n_counties)
+    reference = pd.DataFrame(
+        {
+            "UID": 84000000 + ids,
+            "iso2": "US",
+            "iso3": "USA",
+            "code3": 840,
+            "FIPS": (1000 + ids).astype(float),
+            "Admin2": [f"County {i}" for i in ids],
+            "Province_State": [f"State {i % n_states}" for i in ids],
+            "Country_Region": "US",
+            "Lat": rng.uniform(20, 60, n_counties),
+            "Long_": rng.uniform(-160, -60, n_counties),
+        }
+    )
+    reference["Combined_Key"] = (
+        reference["Admin2"] + ", " + reference["Province_State"] + ", US"
+    )
+    reference["Population"] = rng.integers(1000, 1000000, n_counties)
+    headers = date_headers(n_days)
+    confirmed = pd.concat(
+        [
+            reference.drop("Population", axis=1),
+            pd.DataFrame(
+                cumulative(rng, n_counties, n_days, 20), columns=headers
+            ),
+        ],
+        axis=1,
+    )
+    deaths = pd.concat(
+        [
+            reference,
+            pd.DataFrame(
+                cumulative(rng, n_counties, n_days, 2), columns=headers
+            ),
+        ],
+        axis=1,
+    )
+    return {"confirmed": confirmed, "dead": deaths, "reference": reference}
+
+
+def rki_line_list(n_rows, n_days, seed=0):
+    # RKI line list: one row per reported group of cases
+    rng = np.random.default_rng(seed)
+    bundesland = rng.integers(1, 17, n_rows)
+    # make sure every Bundesland and Guenzburg (9774) shows up
+    bundesland[:16] = np.arange(1, 17)
+    landkreis = bundesland * 1000 + rng.integers(1, 80, n_rows)
+    landkreis[16:32] = 9774
+    bundesland[16:32] = 9
+    dates = pd.to_datetime(days(n_days)).values
+    meldedatum = dates[rng.integers(0, n_days, n_rows)]
+    return pd.DataFrame(
+        {
+            "ObjectId": np.arange(n_rows),
+            "IdBundesland": bundesland,
+            "Bundesland": [f"Bundesland {i}" for i in bundesland],
+            "Landkreis": [f"LK {i}" for i in landkreis],
+            "Altersgruppe": np.array(age_groups)[
+                rng.integers(0, len(age_groups), n_rows)
+            ],
+            "Geschlecht": np.where(rng.random(n_rows) < 0.5, "M", "W"),
+            "AnzahlFall": rng.integers(1, 5, n_rows),
+            "AnzahlTodesfall": rng.binomial(1, 0.02, n_rows),
+            "Meldedatum": meldedatum,
+            "IdLandkreis": landkreis,
+            "NeuerFall": 0,
+            "NeuerTodesfall": -9,
+            "Refdatum": meldedatum,
+        }
+    )
@@ -0,0 +1,119 @@
+import json
+import os
+
+import plotly
+import plotly.io as pio
+
+from output import replacing
+
+# With COVID_DASHBOARD=1 the figures are written as JSON specs instead of
+# standalone HTML files (each embedding all of plotly.js). docs/index.html
+# becomes a shell loading plotly.js once from a shared asset and fetching a
+# figure's spec when its tab is opened. Every plot script lists its figures
+# in plots/<group>_figures.json.
+enabled = os.environ.get("COVID_DASHBOARD", "") not in ("", "0")
+docs_dir = "../docs"
+groups = ["jh", "rki"]
+asset = f"plotly-{plotly.__version__}.min.js"
+
+shell = """<html>
+    <head>
+        <title>Corona Auswertungen</title>
+        <meta charset="utf-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1">
+        <script src="plots/{asset}" defer></script>
+        <style>
+            body {{ font-family: sans-serif; margin: 0.5em; }}
+            nav button {{ margin: 0.1em; }}
+            nav button.active {{ font-weight: bold; }}
+            #figure {{ width: 100%; height: 85vh; }}
+        </style>
+    </head>
+    <body>
+        <nav id="tabs"></nav>
+        <div id="figure">Loading...</div>
+        <script>
+            var groups = {groups};
+            var specs = {{}};
+
+            function show(name, button) {{
+                document.querySelectorAll("nav button").forEach(
+                    function (b) {{ b.classList.remove("active"); }});
+                button.classList.add("active");
+                location.hash = name;
+                if (!specs[name]) {{
+                    specs[name] = fetch("plots/" + name + ".json").then(
+                        function (response) {{ return response.json(); }});
+                }}
+                specs[name].then(function (spec) {{
+                    var draw = function () {{
+                        Plotly.react("figure", spec.data, spec.layout,
+                                     {{responsive: true}});
+                    }};
+                    if (window.Plotly) {{
+                        draw();
+                    }} else {{
+                        window.addEventListener("load", draw);
+                    }}
+                }});
+            }}
+
+            Promise.all(groups.map(function (group) {{
+                return fetch("plots/" + group + "_figures.json").then(
+                    function (response) {{
+                        return response.ok ? response.json() : [];
+                    }});
+            }})).then(function (lists) {{
+                var tabs = document.getElementById("tabs");
+                var buttons = {{}};
+                [].concat.apply([], lists).forEach(function (name) {{
+                    var button = document.createElement("button");
+                    button.textContent = name;
+                    button.onclick = function () {{ show(name, button); }};
+                    tabs.appendChild(button);
+                    buttons[name] = button;
+                }});
+                var first = location.hash.slice(1);
+                first = buttons[first] ? first : Object.keys(buttons)[0];
+                if (first) {{
+                    show(first, buttons[first]);
+                }}
+            }});
+        </script>
+    </body>
+</html>
+"""
+
+
+def write_figure(fig, path: str):
+    # Writes fig to path as html, or in dashboard mode as json next to it.
+    # Returns the path written.
+    if not enabled:
+        fig.write_html(path)
+        return path
+    path = os.path.splitext(path)[0] + ".json"
+    with replacing(path) as tmp_path:
+        with open(tmp_path, "w") as fp:
+            fp.write(pio.to_json(fig, validate=False))
+    return path
+
+
+def write_index(group: str, names):
+    # In dashboard mode, lists the figures names (their file names without
+    # extension) as group and writes the shell and the plotly.js asset (once
+    # per version).
+    if not enabled:
+        return
+    plots_dir = os.path.join(docs_dir, "plots")
+    with replacing(os.path.join(plots_dir, f"{group}_figures.json")) as tmp:
+        with open(tmp, "w") as fp:
+            json.dump(list(names), fp, indent=2)
+
+    asset_path = os.path.join(plots_dir, asset)
+    if not os.path.exists(asset_path):
+        with replacing(asset_path) as tmp_path:
+            with open(tmp_path, "w", encoding="utf-8") as fp:
+                fp.write(plotly.offline.get_plotlyjs())
+    with replacing(os.path.join(docs_dir, "index.html")) as tmp_path:
+        with open(tmp_path, "w") as fp:
+            fp.write(shell.format(asset=asset, groups=json.dumps(groups)))
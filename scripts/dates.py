@@ -0,0 +1,37 @@
+import pandas as pd
+
+
+def adjust_date(s):
+    l = s.split("/")
+    return f"20{l[2]}-{int(l[0]):02d}-{int(l[1]):02d}"
+
+
+def broadcast(dates, parse):
+    # There are only as many distinct dates as date columns, so each one is
+    # parsed once (parse gets and returns an Index) and the result is
+    # broadcast to all rows by its code; missing dates stay missing.
+    codes, uniques = pd.factorize(dates)
+    parsed = parse(pd.Index(uniques.to_numpy(dtype=object), dtype=object))
+    values = parsed.take(codes)
+    if (codes < 0).any():
+        values = values.where(codes >= 0)
+    if isinstance(dates, pd.Series):
+        return pd.Series(values, index=dates.index, name=dates.name)
+    return values
+
+
+def normalize_dates(dates):
+    # Convert the JHU date headers ("1/22/20") of a long table to ISO dates.
+    return broadcast(
+        dates,
+        lambda uniques: pd.Index(
+            [adjust_date(d) for d in uniques], dtype=object
+        ),
+    )
+
+
+def parse_iso_dates(dates):
+    # ISO date strings as datetime64, for the columnar outputs
+    return broadcast(
+        dates, lambda uniques: pd.to_datetime(uniques, format="%Y-%m-%d")
+    )
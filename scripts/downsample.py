@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Shrinks the traces of the plots: every trace is reduced to at most
+# COVID_PLOT_POINTS points with Largest-Triangle-Three-Buckets, which keeps
+# the peaks and the shape of the curve, and its values are rounded to
+# COVID_PLOT_DECIMALS decimals. Both are off by default.
+max_points = int(os.environ.get("COVID_PLOT_POINTS", "0"))
+decimals = os.environ.get("COVID_PLOT_DECIMALS", "")
+decimals = int(decimals) if decimals else None
+
+
+def lttb(x, y, n_out: int):
+    # Indices of the n_out points (first and last included) that keep the
+    # largest triangles between neighbouring buckets; x and y numeric.
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = x.astype(np.float64)
+    y = np.nan_to_num(y.astype(np.float64))
+    # n_out - 2 buckets between the first and the last point
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_lo, next_hi = (
+            (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        )
+        next_x = x[next_lo:next_hi].mean()
+        next_y = y[next_lo:next_hi].mean()
+        area = np.abs(
+            (x[a] - next_x) * (y[lo:hi] - y[a])
+            - (x[a] - x[lo:hi]) * (next_y - y[a])
+        )
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def numeric(x):
+    # dates (as strings or datetimes) as nanoseconds, numbers as they are
+    x = np.asarray(x)
+    if x.dtype.kind in "iuf":
+        return x
+    return pd.to_datetime(x).values.astype("datetime64[ns]").astype(np.int64)
+
+
+def reduce_trace(x, y):
+    # the x and y of a trace, downsampled and rounded as configured
+    x, y = np.asarray(x), np.asarray(y)
+    if max_points and len(x) > max_points:
+        selected = lttb(numeric(x), y, max_points)
+        x, y = x[selected], y[selected]
+    if decimals is not None and y.dtype.kind == "f":
+        y = np.round(y, decimals)
+    return x, y
+
+
+def report_figure(fig, path: str):
+    # prints and returns the points of all traces of fig, written to path
+    points = sum(len(trace.x) for trace in fig.data if trace.x is not None)
+    size = os.path.getsize(path)
+    print(f"  {os.path.basename(path)}: {points} points, {size / 1e6:.2f} MB")
+    return points
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from instrument import stage
+
+# Downloads are kept in cache_dir, keyed by url. A cached file is revalidated
+# with ETag / If-Modified-Since and reused if upstream answers 304. In offline
+# mode only the cache is used.
+cache_dir = os.environ.get(
+    "COVID_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".cache"),
+)
+offline = os.environ.get("COVID_OFFLINE", "") not in ("", "0")
+default_timeout = 60  # seconds
+retries = 3
+backoff = 2.0  # seconds before the first retry, doubled for every further
+max_workers = int(os.environ.get("COVID_FETCH_WORKERS", "4"))
+
+jhu_url = "https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/"
+jhu_series_url = jhu_url + "csse_covid_19_time_series/"
+# everything the pipeline downloads
+sources = {
+    "confirmed_global": jhu_series_url
+    + "time_series_covid19_confirmed_global.csv",
+    "deaths_global": jhu_series_url + "time_series_covid19_deaths_global.csv",
+    "recovered_global": jhu_series_url
+    + "time_series_covid19_recovered_global.csv",
+    "confirmed_us": jhu_series_url + "time_series_covid19_confirmed_US.csv",
+    "deaths_us": jhu_series_url + "time_series_covid19_deaths_US.csv",
+    "reference": jhu_url + "UID_ISO_FIPS_LookUp_Table.csv",
+    "combined": "https://raw.githubusercontent.com/datasets/covid-19/master/data/time-series-19-covid-combined.csv",
+    "rki": "https://www.arcgis.com/sharing/rest/content/items/66876b81065340a4a48710b062319336/data",
+}
+
+
+class FetchError(Exception):
+    pass
+
+
+def cache_paths(url, directory):
+    name = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    return (
+        os.path.join(directory, name),
+        os.path.join(directory, name + ".json"),
+    )
+
+
+def fetch(
+    url: str,
+    directory: str = None,
+    offline_only: bool = None,
+    timeout: float = None,
+):
+    # Returns the path of a local copy of url. Local paths are passed through
+    # unchanged. Network errors and 5xx answers are retried with backoff.
+    if not url.startswith(("http://", "https://")):
+        return url
+    directory = directory or cache_dir
+    offline_only = offline if offline_only is None else offline_only
+    data_path, meta_path = cache_paths(url, directory)
+
+    meta = None
+    if os.path.exists(data_path):
+        try:
+            with open(meta_path) as fp:
+                meta = json.load(fp)
+        except (OSError, ValueError):
+            meta = {}
+    if offline_only:
+        if meta is None:
+            raise FetchError(f"{url} is not cached (offline mode)")
+        return data_path
+
+    request = urllib.request.Request(url)
+    if meta:
+        if meta.get("etag"):
+            request.add_header("If-None-Match", meta["etag"])
+        if meta.get("last_modified"):
+            request.add_header("If-Modified-Since", meta["last_modified"])
+    timeout = timeout or default_timeout
+    for attempt in range(retries + 1):
+        try:
+            return download(request, data_path, meta_path, meta, timeout)
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and meta is not None:
+                print(f"  {url}: not modified, using cache")
+                return data_path
+            if e.code < 500 or attempt == retries:
+                raise
+        except OSError:  # URLError, timeouts, connection resets
+            if attempt == retries:
+                raise
+        delay = backoff * 2**attempt
+        print(f"  {url}: retrying in {delay:.0f}s")
+        time.sleep(delay)
+
+
+def download(request, data_path, meta_path, meta, timeout):
+    response = urllib.request.urlopen(request, timeout=timeout)
+    directory = os.path.dirname(data_path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with response, os.fdopen(fd, "wb") as fp:
+            shutil.copyfileobj(response, fp)
+            headers = response.headers
+        os.replace(tmp_path, data_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    with open(meta_path, "w") as fp:
+        json.dump(
+            {
+                "url": request.full_url,
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+            },
+            fp,
+        )
+    return data_path
+
+
+def fetch_all(urls: dict, timeouts: dict = None, workers: int = None):
+    # Download all urls ({name: url}) concurrently, returns {name: path}.
+    # timeouts optionally holds a timeout in seconds per name.
+    timeouts = timeouts or {}
+    with ThreadPoolExecutor(max_workers=workers or max_workers) as pool:
+        futures = {
+            name: pool.submit(fetch, url, timeout=timeouts.get(name))
+            for name, url in urls.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+
+def read_all(urls: dict, timeouts: dict = None, workers: int = None):
+    # Like fetch_all, but also parses the csv files: returns {name: frame}
+    def read(url, timeout):
+        name = os.path.basename(url)
+        with stage(f"download: {name}"):
+            path = fetch(url, timeout=timeout)
+        with stage(f"parse: {name}") as parsed:
+            df = pd.read_csv(path)
+            parsed.rows_out = len(df)
+        return df
+
+    timeouts = timeouts or {}
+    # the stages of the threads have no memory peak (see instrument), this
+    # one has theirs
+    with stage(f"read: {', '.join(urls)}") as read_stage:
+        with ThreadPoolExecutor(max_workers=workers or max_workers) as pool:
+            futures = {
+                name: pool.submit(read, url, timeouts.get(name))
+                for name, url in urls.items()
+            }
+            frames = {
+                name: future.result() for name, future in futures.items()
+            }
+        read_stage.rows_out = sum(len(df) for df in frames.values())
+    return frames
+
+
+def read_csv_cached(path: str, directory: str = None, **kwargs):
+    # pd.read_csv(path, **kwargs), with the parsed frame kept as a pickle in
+    # the cache directory (dtypes included) and reused until the file at path
+    # changes
+    directory = directory or cache_dir
+    stat = os.stat(path)
+    stamp = {
+        "path": os.path.abspath(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "options": repr(sorted(kwargs.items())),
+        "pandas": pd.__version__,
+    }
+    data_path, meta_path = cache_paths("parsed:" + stamp["path"], directory)
+    try:
+        with open(meta_path) as fp:
+            if json.load(fp) == stamp:
+                return pd.read_pickle(data_path)
+    except Exception:  # not cached yet or unreadable, parse again
+        pass
+
+    df = pd.read_csv(path, **kwargs)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    os.close(fd)
+    df.to_pickle(tmp_path)
+    os.replace(tmp_path, data_path)
+    with open(meta_path, "w") as fp:
+        json.dump(stamp, fp)
+    return df
+
+
+if __name__ == "__main__":
+    # warm the cache for all sources at once
+    for name, path in fetch_all(sources).items():
+        print(f"{name}: {path}")
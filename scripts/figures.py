@@ -0,0 +1,63 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
+import instrument
+from dashboard import write_figure, write_index
+from downsample import report_figure
+from instrument import stage, written
+
+# Figures are declared as data and rendered in a pool of COVID_PLOT_WORKERS
+# processes (default: cores, 1 renders in this process). A figure is a dict
+#   {"name": ..., "path": ..., "yaxis": ..., "yaxis2": ... (optional),
+#    "traces": [{"name": ..., "x": ..., "y": ..., "secondary": ...,
+#                "color": ... (optional)}, ...]}
+# holding only the aggregated arrays of its traces.
+workers = int(os.environ.get("COVID_PLOT_WORKERS", "0")) or None
+
+
+def render(figure):
+    # builds and writes one figure, returns its name
+    with stage(f"render: {figure['name']}") as rendered:
+        fig = make_subplots(specs=[[{"secondary_y": True}]])
+        fig.update_xaxes(title_text="Date")
+        fig.update_yaxes(title_text=figure["yaxis"])
+        if "yaxis2" in figure:
+            fig.update_yaxes(title_text=figure["yaxis2"], secondary_y=True)
+        for trace in figure["traces"]:
+            scatter = go.Scatter(
+                x=trace["x"], y=trace["y"], mode="lines", name=trace["name"]
+            )
+            if trace.get("color"):
+                scatter.marker = {"color": trace["color"]}
+            fig.add_trace(scatter, secondary_y=trace["secondary"])
+        path = write_figure(fig, figure["path"])
+        written(path)
+        rendered.rows_out = report_figure(fig, path)
+    return figure["name"]
+
+
+def render_measured(figure):
+    # render in a worker, returning the measurements along with the name
+    del instrument.records[:]
+    name = render(figure)
+    return name, list(instrument.records)
+
+
+def render_all(figures, group: str):
+    # Renders all figures, in parallel where the processes can be forked
+    # (spawned workers would run the calling plot script again), and lists
+    # them as group for the dashboard.
+    if workers == 1 or "fork" not in multiprocessing.get_all_start_methods():
+        names = [render(figure) for figure in figures]
+    else:
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(workers, mp_context=context) as pool:
+            names = []
+            for name, records in pool.map(render_measured, figures):
+                names.append(name)
+                instrument.records += records
+    write_index(group, names)
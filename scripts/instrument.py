@@ -0,0 +1,157 @@
+import atexit
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+import tracemalloc
+
+# Per-stage measurements (wall and CPU time, peak traced memory, rows in and
+# out, bytes written), enabled by COVID_PROFILE=report.json. The records are
+# written there as JSON when the process exits, and as a Prometheus textfile
+# to COVID_PROFILE_PROM if set. Disabled, stage() costs next to nothing.
+# tracemalloc has one peak for the whole process, so only stages of the main
+# thread measure it; stages in other threads (running side by side, e.g. the
+# downloads of fetch.read_all) have no peak, theirs counts towards the main
+# thread stage around them.
+report_path = os.environ.get("COVID_PROFILE", "")
+prometheus_path = os.environ.get("COVID_PROFILE_PROM", "")
+enabled = bool(report_path)
+if enabled:
+    # relative to the directory the process was started in
+    report_path = os.path.abspath(report_path)
+    if prometheus_path:
+        prometheus_path = os.path.abspath(prometheus_path)
+
+records = []
+metrics = {
+    "wall_s": ("wall_seconds", "Wall time of the stage"),
+    "cpu_s": ("cpu_seconds", "CPU time of the process during the stage"),
+    "peak_mb": ("peak_traced_megabytes", "Peak memory traced by tracemalloc"),
+    "rows_in": ("rows_in", "Rows going into the stage"),
+    "rows_out": ("rows_out", "Rows coming out of the stage"),
+    "bytes_written": ("bytes_written", "Bytes of the files written"),
+}
+_local = threading.local()
+
+
+class Stage:
+    # the measurements of one stage; name (if only known later), rows_in and
+    # rows_out may be set by the caller
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.bytes_written = 0
+        self.peak = 0
+
+
+class _Disabled:
+    # stands in for Stage when disabled, takes the attributes and drops them
+    def __setattr__(self, name, value):
+        pass
+
+
+_disabled = _Disabled()
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+@contextlib.contextmanager
+def stage(name: str, rows_in: int = None):
+    # with stage("us: reshape", rows_in=len(df)) as s: ...; s.rows_out = ...
+    if not enabled:
+        yield _disabled
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    stack = _stack()
+    peaks = threading.current_thread() is threading.main_thread()
+    if peaks:
+        # the peak so far belongs to the enclosing stages, the counter is
+        # reset for this one
+        for outer in stack:
+            outer.peak = max(outer.peak, tracemalloc.get_traced_memory()[1])
+        if hasattr(tracemalloc, "reset_peak"):  # Python 3.9+
+            tracemalloc.reset_peak()
+    current = Stage(name, rows_in)
+    stack.append(current)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield current
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        stack.pop()
+        if peaks:
+            current.peak = max(
+                current.peak, tracemalloc.get_traced_memory()[1]
+            )
+        for outer in stack:
+            outer.peak = max(outer.peak, current.peak)
+            outer.bytes_written += current.bytes_written
+        records.append(
+            {
+                "stage": current.name,
+                "wall_s": wall,
+                "cpu_s": cpu,
+                "peak_mb": current.peak / 1e6 if peaks else None,
+                "rows_in": current.rows_in,
+                "rows_out": current.rows_out,
+                "bytes_written": current.bytes_written,
+            }
+        )
+
+
+def written(path: str, size: int = None):
+    # count a file (or size bytes of it) as written by the current stage
+    if enabled and _stack():
+        _stack()[-1].bytes_written += (
+            os.path.getsize(path) if size is None else size
+        )
+
+
+def prometheus_text(records):
+    # gauges per stage; stages that ran more than once are summed up
+    totals = {}
+    for record in records:
+        stage_totals = totals.setdefault(record["stage"], {})
+        for key in metrics:
+            if record.get(key) is not None:
+                stage_totals[key] = stage_totals.get(key, 0) + record[key]
+    lines = []
+    for key, (metric, help_text) in metrics.items():
+        lines += [
+            f"# HELP covid_stage_{metric} {help_text}",
+            f"# TYPE covid_stage_{metric} gauge",
+        ]
+        for name, stage_totals in totals.items():
+            if key in stage_totals:
+                label = re.sub(r'(["\\])', r"\\\1", name)
+                lines.append(
+                    f'covid_stage_{metric}{{stage="{label}"}} '
+                    f"{stage_totals[key]:g}"
+                )
+    return "\n".join(lines) + "\n"
+
+
+def write_report():
+    with open(report_path, "w") as fp:
+        json.dump(records, fp, indent=2)
+    if prometheus_path:
+        # written next to the target and renamed, as the node exporter's
+        # textfile collector expects
+        tmp_path = prometheus_path + ".tmp"
+        with open(tmp_path, "w") as fp:
+            fp.write(prometheus_text(records))
+        os.replace(tmp_path, prometheus_path)
+
+
+if enabled:
+    atexit.register(write_report)
@@ -0,0 +1,154 @@
+import contextlib
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+from dates import parse_iso_dates
+from instrument import written
+
+# Besides the csv, write every dataset in these columnar formats ("parquet",
+# "feather"), e.g. COVID_COLUMNAR=parquet,feather. Needs pyarrow.
+columnar_formats = [
+    fmt for fmt in os.environ.get("COVID_COLUMNAR", "").split(",") if fmt
+]
+datapackage_path = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "datapackage.json"
+)
+
+
+@contextlib.contextmanager
+def replacing(path: str):
+    # Yields a temporary path next to path, which is renamed into place when
+    # the block succeeds, so readers never see a half written file.
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.chmod(tmp_path, 0o644)  # mkstemp creates the file as 0600
+        os.replace(tmp_path, path)
+        written(path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_csv(df, path: str, **kwargs):
+    kwargs.setdefault("index", False)
+    with replacing(path) as tmp_path:
+        with open(tmp_path, "w", newline="") as fp:
+            df.to_csv(fp, **kwargs)
+
+
+def append_csv(df, path: str):
+    # add rows to an existing csv written with the same columns
+    size = os.path.getsize(path)
+    df.to_csv(path, mode="a", header=False, index=False)
+    written(path, os.path.getsize(path) - size)
+
+
+def write_dataset(df, path: str):
+    # the csv at path plus the enabled columnar copies next to it
+    write_csv(df, path)
+    for fmt in columnar_formats:
+        write_columnar(df, path, fmt)
+
+
+def append_dataset(df, path: str):
+    # Appends to the csv. Columnar files can't be appended to, they are read
+    # back (cheap compared to the csv) and rewritten with the new rows.
+    append_csv(df, path)
+    for fmt in columnar_formats:
+        old = read_columnar(path, fmt)
+        new = typed(df, path)
+        write_columnar(pd.concat([old, new], ignore_index=True), path, fmt)
+
+
+def field_types(path: str):
+    # {column: type} from the schema of the resource at path in
+    # datapackage.json. Fields with the date format update_datapackage.py
+    # sets are dates, whatever their declared type.
+    with open(datapackage_path) as fp:
+        resources = json.load(fp)["resources"]
+    for resource in resources:
+        if resource["path"] == path:
+            return {
+                field["name"]: (
+                    "date"
+                    if field.get("format") == "%Y-%m-%d"
+                    else field["type"]
+                )
+                for field in resource["schema"]["fields"]
+            }
+    return {}
+
+
+def typed(df, path: str):
+    # The columns converted to the types of the datapackage schema: dates
+    # become datetime64, integer columns with gaps nullable integers.
+    df = df.copy()
+    for column, kind in field_types(path).items():
+        if column not in df:
+            continue
+        values = df[column]
+        if kind == "date":
+            df[column] = parse_iso_dates(values)
+        elif kind == "integer" and not pd.api.types.is_integer_dtype(values):
+            df[column] = values.astype("Int64")
+        elif kind == "number":
+            df[column] = values.astype("float64")
+        elif kind == "string" and (
+            values.dtype == object or values.isna().all()
+        ):
+            # all empty columns are read back from csv as floats
+            df[column] = values.astype("string")
+    return df
+
+
+def columnar_path(path: str, fmt: str):
+    return os.path.splitext(path)[0] + "." + fmt
+
+
+def write_columnar(df, path: str, fmt: str, resource: str = None):
+    # Parquet files get one row group per month of Date, so readers can skip
+    # the date ranges they don't need. The types come from the schema of
+    # resource (default path), e.g. of the full table for a part of it.
+    try:
+        import pyarrow as pa
+        import pyarrow.feather as feather
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError(
+            "columnar output needs pyarrow (pip install pyarrow)"
+        )
+
+    df = typed(df, resource or path)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with replacing(columnar_path(path, fmt)) as tmp_path:
+        if fmt == "feather":
+            feather.write_feather(table, tmp_path)
+        elif fmt == "parquet":
+            with pq.ParquetWriter(tmp_path, table.schema) as writer:
+                for rows in month_rows(df):
+                    writer.write_table(table.take(rows))
+        else:
+            raise ValueError(f"unknown columnar format {fmt}")
+
+
+def month_rows(df):
+    # row positions per month of Date (all rows at once without dates)
+    if "Date" not in df or not len(df):
+        yield list(range(len(df)))
+        return
+    months = pd.to_datetime(df["Date"]).dt.to_period("M")
+    indices = months.groupby(months).indices
+    for month in sorted(indices):
+        yield indices[month]
+
+
+def read_columnar(path: str, fmt: str):
+    if fmt == "feather":
+        return pd.read_feather(columnar_path(path, fmt))
+    return pd.read_parquet(columnar_path(path, fmt))
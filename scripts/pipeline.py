@@ -0,0 +1,403 @@
+"""
+Runs the scripts of the pipeline as stages, independent ones in parallel.
+
+Every stage declares the files (or download sources, see fetch.sources) it
+reads and the files it writes; a stage runs once the stages writing its
+inputs are done. The worldwide, US and RKI branches run side by side.
+
+A stage whose code and inputs hash to the same value as on its last
+successful run is not run again, its outputs are left untouched (--force
+runs it anyway).
+
+With COVID_PROFILE=report.json, the measurements of all stages (see
+instrument.py) end up in one report.
+
+    python scripts/pipeline.py                    # all stages
+    python scripts/pipeline.py plot plot_rki      # only these
+    python scripts/pipeline.py datapackage --upstream -j 2
+"""
+
+import argparse
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import runpy
+import sys
+import time
+import traceback
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+
+import fetch
+import instrument
+from output import replacing
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+repo = os.path.dirname(scripts_dir)
+
+# the input hash of every stage at its last successful run
+state_file = os.path.join(repo, "data", ".pipeline_state.json")
+# modules the scripts share, part of the code version of every stage
+shared_code = [
+    "dashboard.py",
+    "dates.py",
+    "downsample.py",
+    "fetch.py",
+    "figures.py",
+    "output.py",
+]
+# environment variables changing what the stages write
+hashed_env = [
+    "COVID_COLUMNAR",
+    "COVID_COUNTRY_METRICS",
+    "COVID_DASHBOARD",
+    "COVID_INCREMENTAL",
+    "COVID_PARTITIONED",
+    "COVID_PLOT_ALL_COUNTRIES",
+    "COVID_PLOT_DECIMALS",
+    "COVID_PLOT_POINTS",
+    "COVID_STREAMING",
+]
+# offline mode as configured, see run_stage
+offline = fetch.offline
+
+# {name: stage}; cwd, inputs and outputs are relative to the repository,
+# outputs may be glob patterns
+stages = {
+    "worldwide": {
+        "script": "process_worldwide.py",
+        "cwd": ".",
+        "inputs": ["confirmed_global", "deaths_global", "recovered_global"],
+        "outputs": [
+            "data/countries-aggregated.csv",
+            "data/time-series-19-covid-combined.csv",
+            "data/key-countries-pivoted.csv",
+            "data/worldwide-aggregate.csv",
+        ],
+    },
+    "us": {
+        "script": "process_us.py",
+        "cwd": ".",
+        "inputs": ["confirmed_us", "deaths_us", "reference"],
+        "outputs": [
+            "data/us_confirmed.csv",
+            "data/us_deaths.csv",
+            "data/us_simplified.csv",
+            "data/us_per_capita.csv",
+            "data/reference.csv",
+        ],
+    },
+    "datapackage": {
+        # data/datapackage.json is generated from data/ by the data cli
+        "script": "update_datapackage.py",
+        "cwd": ".",
+        "inputs": [
+            "data/datapackage.json",
+            "data/countries-aggregated.csv",
+            "data/us_simplified.csv",
+        ],
+        "outputs": ["datapackage.json"],
+    },
+    "plot": {
+        "script": "plot.py",
+        "cwd": "scripts",
+        # prefers the combined time series of worldwide if it is recent
+        "inputs": ["combined", "data/time-series-19-covid-combined.csv"],
+        "outputs": ["docs/plots/jh_*"],
+    },
+    "plot_rki": {
+        "script": "plot_rki.py",
+        "cwd": "scripts",
+        "inputs": ["rki"],
+        "outputs": ["scripts/rki_data.csv", "docs/plots/rki_*"],
+    },
+}
+
+
+def dependencies(name):
+    # the stages writing any of the inputs of stage name
+    inputs = stages[name]["inputs"]
+    return {
+        other
+        for other, stage in stages.items()
+        if other != name
+        and any(
+            fnmatch.fnmatch(path, pattern)
+            for path in inputs
+            for pattern in stage["outputs"]
+        )
+    }
+
+
+def with_upstream(names):
+    selected = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending += dependencies(name)
+    return selected
+
+
+def missing_inputs(name):
+    # local inputs of stage name that no stage writes and that don't exist,
+    # e.g. data/datapackage.json, which update_datapackage.py deletes
+    produced = [
+        pattern for stage in stages.values() for pattern in stage["outputs"]
+    ]
+    return [
+        path
+        for path in stages[name]["inputs"]
+        if path not in fetch.sources
+        and not any(fnmatch.fnmatch(path, pattern) for pattern in produced)
+        and not os.path.exists(os.path.join(repo, path))
+    ]
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def prefetch(names):
+    # Revalidates the downloads of the stages names all at once, concurrently
+    # as in fetch.fetch_all. Returns {source: path} of the ones available.
+    sources = sorted(
+        {
+            source
+            for name in names
+            for source in stages[name]["inputs"]
+            if source in fetch.sources
+        }
+    )
+    with ThreadPoolExecutor(max_workers=fetch.max_workers) as pool:
+        futures = {
+            source: pool.submit(fetch.fetch, fetch.sources[source])
+            for source in sources
+        }
+    paths = {}
+    for source, future in futures.items():
+        try:
+            paths[source] = future.result()
+        except Exception as e:
+            print(f"[pipeline] can't fetch {source}: {e}")
+    return paths
+
+
+def stage_hash(name, downloads):
+    # Hash of the code, the inputs and the settings of stage name, with the
+    # downloads ({source: path}) prefetched; None if an input is unavailable.
+    stage = stages[name]
+    paths = {
+        code: os.path.join(scripts_dir, code)
+        for code in [stage["script"]] + shared_code
+    }
+    try:
+        for source in stage["inputs"]:
+            if source in fetch.sources:
+                if source not in downloads:
+                    raise fetch.FetchError(f"{source} was not fetched")
+                paths[source] = downloads[source]
+            else:
+                paths[source] = os.path.join(repo, source)
+        digests = {key: file_digest(path) for key, path in paths.items()}
+    except Exception as e:
+        print(f"[pipeline] can't hash the inputs of {name}: {e}")
+        return None
+    digests.update({var: os.environ.get(var, "") for var in hashed_env})
+    return hashlib.sha256(
+        json.dumps(digests, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def outputs_exist(name):
+    return all(
+        glob.glob(os.path.join(repo, pattern))
+        for pattern in stages[name]["outputs"]
+    )
+
+
+def load_state():
+    try:
+        with open(state_file) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state):
+    with replacing(state_file) as tmp_path:
+        with open(tmp_path, "w") as fp:
+            json.dump(state, fp, indent=2, sort_keys=True)
+
+
+def run_stage(name, prefetched=False):
+    # Runs the script of stage name in this (worker) process as if started
+    # from its directory. Returns (ok, seconds, traceback, measurements).
+    # With prefetched the downloads were just revalidated by prefetch, the
+    # cache is used.
+    stage = stages[name]
+    if scripts_dir not in sys.path:
+        sys.path.insert(0, scripts_dir)
+    fetch.offline = offline or prefetched
+    os.chdir(os.path.join(repo, stage["cwd"]))
+    del instrument.records[:]
+    start = time.perf_counter()
+    error = None
+    with instrument.stage(f"pipeline: {name}"):
+        try:
+            runpy.run_path(
+                os.path.join(scripts_dir, stage["script"]),
+                run_name="__main__",
+            )
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                error = f"exit code {e.code}"
+        except Exception:
+            error = traceback.format_exc()
+    seconds = time.perf_counter() - start
+    return error is None, seconds, error, list(instrument.records)
+
+
+def run(names, jobs=None, force=False):
+    # Runs the stages names, each as soon as the selected stages it depends
+    # on succeeded; dependents of failed stages are skipped, unchanged
+    # stages reused, stages without their external inputs left out (status
+    # "missing", their outputs stay as they are). Returns {name: (status,
+    # seconds)}.
+    names = set(names)
+    waiting = {name: dependencies(name) & names for name in names}
+    failed = set()
+    results = {}
+    state = load_state()
+    hashes = {}
+    downloads = prefetch(names)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        running = {}
+        while waiting or running:
+            blocked = [name for name in waiting if waiting[name] & failed]
+            while blocked:
+                for name in blocked:
+                    del waiting[name]
+                    failed.add(name)
+                    results[name] = ("skipped", 0.0)
+                    print(f"[pipeline] skipping {name}")
+                blocked = [name for name in waiting if waiting[name] & failed]
+            ready = [name for name in sorted(waiting) if not waiting[name]]
+            while ready:
+                for name in ready:
+                    del waiting[name]
+                    missing = missing_inputs(name)
+                    if missing:
+                        print(
+                            f"[pipeline] skipping {name}, input missing: "
+                            + ", ".join(missing)
+                        )
+                        results[name] = ("missing", 0.0)
+                        for after in waiting.values():
+                            after.discard(name)
+                        continue
+                    hashes[name] = stage_hash(name, downloads)
+                    if (
+                        not force
+                        and hashes[name] is not None
+                        and hashes[name] == state.get(name)
+                        and outputs_exist(name)
+                    ):
+                        print(f"[pipeline] {name} unchanged, reusing outputs")
+                        results[name] = ("reused", 0.0)
+                        for after in waiting.values():
+                            after.discard(name)
+                    else:
+                        print(f"[pipeline] starting {name}")
+                        prefetched = hashes[name] is not None
+                        future = pool.submit(run_stage, name, prefetched)
+                        running[future] = name
+                ready = [name for name in sorted(waiting) if not waiting[name]]
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                ok, seconds, error, records = future.result()
+                instrument.records += records
+                results[name] = ("ok" if ok else "failed", seconds)
+                print(f"[pipeline] {name} {results[name][0]} ({seconds:.1f}s)")
+                if error:
+                    print(error, file=sys.stderr)
+                if ok:
+                    for after in waiting.values():
+                        after.discard(name)
+                    if hashes[name] is not None:
+                        state[name] = hashes[name]
+                        save_state(state)
+                else:
+                    failed.add(name)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "stages",
+        nargs="*",
+        help=f"stages to run (default all: {', '.join(stages)})",
+    )
+    parser.add_argument(
+        "--upstream",
+        action="store_true",
+        help="also run the stages the given ones depend on",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, help="parallel stages (default: cores)"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="run the stages even if their inputs are unchanged",
+    )
+    parser.add_argument(
+        "--list", action="store_true", help="show the stages and exit"
+    )
+    args = parser.parse_args()
+
+    if args.list:
+        for name in stages:
+            after = ", ".join(sorted(dependencies(name))) or "-"
+            print(f"{name:12} {stages[name]['script']:24} after: {after}")
+        return
+    unknown = set(args.stages) - set(stages)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+    names = args.stages or list(stages)
+    if args.upstream:
+        names = with_upstream(names)
+
+    start = time.perf_counter()
+    results = run(names, args.jobs, args.force)
+    print(f"\n{'stage':12} {'status':8} {'wall [s]':>10}")
+    for name in stages:
+        if name in results:
+            status, seconds = results[name]
+            print(f"{name:12} {status:8} {seconds:10.1f}")
+    print(f"{'total':12} {'':8} {time.perf_counter() - start:10.1f}")
+    reused = [
+        name for name in stages if results.get(name, ("",))[0] == "reused"
+    ]
+    print(f"reused: {', '.join(reused) or '-'}")
+    if any(status in ("failed", "skipped") for status, _ in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
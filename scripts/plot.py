@@ -2,21 +2,27 @@
 
 import pandas as pd
 import numpy as np
-import plotly.graph_objects as go
 
 import plotly.io as pio
+import os
 import sys
+import time
 
-from plotly.subplots import make_subplots
+from downsample import reduce_trace
+from fetch import fetch, read_csv_cached, sources
+from figures import render_all
+from instrument import stage
 
 if sys.version_info[0] < 3:
     from StringIO import StringIO
 else:
     from io import StringIO
 
-from_cache = False
-data_url = "https://raw.githubusercontent.com/datasets/covid-19/master/data/time-series-19-covid-combined.csv"
-cache_path = "../raw_data.csv"
+data_url = sources["combined"]
+# process_worldwide.py's version of the same file, used instead of the
+# download if it was written less than local_max_age seconds ago
+local_data_path = "../data/time-series-19-covid-combined.csv"
+local_max_age = 12 * 3600
 pd.options.plotting.backend = "plotly"
 days_till_healthy = 15
 lethality = 0.0157
@@ -25,6 +31,9 @@ data_indices = [8, 6, 4, 7, [6, 8]]
 labels = ["date",
           "confirmed", "deaths", "currently_infected", "confirmed_100k",
           "deaths_100k", "currently_infected_100k", "est_infected_100k", "deaths_100k_14d"]
+# plot every country with known residents instead of interesting_countries
+# (COVID_PLOT_ALL_COUNTRIES=1)
+plot_all_countries = os.environ.get("COVID_PLOT_ALL_COUNTRIES", "") not in ("", "0")
 interesting_countries = sorted(["China",
                                 "Brazil",
                                 "Denmark",
@@ -47,11 +56,21 @@ interesting_countries = sorted(["China",
                                 "South Africa"
                                 ])
 
-if from_cache:
-    raw_data = pd.read_csv(cache_path)
-else:
-    raw_data = pd.read_csv(data_url)
-    raw_data.to_csv(cache_path, index=False, header=True)
+
+def raw_data_path():
+    try:
+        if time.time() - os.path.getmtime(local_data_path) < local_max_age:
+            return local_data_path
+    except OSError:
+        pass
+    # revalidated with upstream, see fetch
+    return fetch(data_url)
+
+
+# parsed only when the file changed, see read_csv_cached
+with stage("plot: load") as loaded:
+    raw_data = read_csv_cached(raw_data_path())
+    loaded.rows_out = len(raw_data)
 residents = pd.read_csv(StringIO("""Country, Residents
 Afghanistan,32890171
 Albania,2845955
@@ -247,80 +266,98 @@ Zimbabwe,15473818
 """))
 
 
-def get_residents(country):
-    try:
-        return residents[residents["Country"] == country].values[0][1]
-    except IndexError:
-        print("country not found: " + country)
+# residents per country, indexed for the lookups
+residents_by_country = residents.set_index("Country").iloc[:, 0]
 
 
-def get_country_data(country):
-    return raw_data[raw_data["Country/Region"] == country]
+def country_matrices(raw_data):
+    # Confirmed and Deaths as countries x dates matrices, provinces summed up
+    totals = raw_data.groupby(["Country/Region", "Date"])[["Confirmed", "Deaths"]].sum()
+    totals = totals.unstack("Date").sort_index(axis=1)
+    return totals["Confirmed"], totals["Deaths"]
 
 
-def calculate_statistics(country):
-    country_data = get_country_data(country)
-    residents = get_residents(country)
-    date = country_data["Date"].values
-    confirmed = country_data["Confirmed"].values
-    deaths = country_data["Deaths"].values
-    currently_infected = confirmed.copy()
-    currently_infected[days_till_healthy:] -= confirmed[:-days_till_healthy]
-    confirmed_100k = confirmed / residents * 100000
-    deaths_100k = deaths / residents * 100000
-    currently_infected = np.where(currently_infected < 0, 0, currently_infected)
-    currently_infected_100k = currently_infected / residents * 100000
-    tmp = confirmed - currently_infected
-    est_infected_100k = deaths / lethality * np.divide(confirmed, tmp, where=tmp != 0) / residents * 100000
+def shifted(values, days):
+    # the values days columns (dates) earlier, zero before the first date
+    result = np.zeros_like(values)
+    result[:, days:] = values[:, :-days]
+    return result
 
-    deaths_100k_14d = deaths_100k.copy()
-    deaths_100k_14d[14:] -= deaths_100k[:-14]
-    deaths_100k_14d = np.where(deaths_100k_14d < 0, 0, deaths_100k_14d)
-    return date, confirmed, deaths, currently_infected, confirmed_100k, deaths_100k, currently_infected_100k, est_infected_100k, deaths_100k_14d
 
+def calculate_all_statistics(raw_data):
+    # Every metric of labels for all countries at once: {label: countries x
+    # dates frame}. Countries without known residents get NaN per-100k rows.
+    confirmed, deaths = country_matrices(raw_data)
+    countries, dates = confirmed.index, confirmed.columns
+    missing = countries.difference(residents_by_country.index)
+    if len(missing):
+        print("countries not found: " + ", ".join(missing))
+    per_100k = 100000 / residents_by_country.reindex(countries).to_numpy(dtype=float)[:, None]
+    c = confirmed.to_numpy(dtype=float)
+    d = deaths.to_numpy(dtype=float)
 
-def add_plot(fig, data, dat_index, secondary=False, ):
+    currently_infected = np.maximum(c - shifted(c, days_till_healthy), 0)
+    recovered = c - currently_infected
+    ratio = np.divide(c, recovered, out=np.full_like(c, np.nan), where=recovered != 0)
+    deaths_100k = d * per_100k
+    deaths_100k_14d = np.maximum(deaths_100k - shifted(deaths_100k, 14), 0)
+    metrics = {
+        "confirmed": c,
+        "deaths": d,
+        "currently_infected": currently_infected,
+        "confirmed_100k": c * per_100k,
+        "deaths_100k": deaths_100k,
+        "currently_infected_100k": currently_infected * per_100k,
+        "est_infected_100k": d / lethality * ratio * per_100k,
+        "deaths_100k_14d": deaths_100k_14d,
+    }
+    return {label: pd.DataFrame(values, index=countries, columns=dates) for label, values in metrics.items()}
+
+
+def calculate_statistics(country):
+    # the metrics of one country in the order of labels
+    return (statistics["confirmed"].columns.values,) + tuple(statistics[label].loc[country].values for label in labels[1:])
+
+
+def add_plot(data, dat_index):
+    # the traces of the figure of dat_index (one label or a pair, the second
+    # on the secondary axis) for all countries of data
+    traces = []
     for d in data:
         if type(dat_index) is not int:
             index = dat_index[0]
         else:
             index = dat_index
-        fig.add_trace(go.Scatter(x=d[1][0], y=d[1][index],
-                                 # mode="lines+markers",
-                                 mode="lines",
-                                 name=d[0]),
-                      secondary_y=False
-                      )
+        x, y = reduce_trace(d[1][0], d[1][index])
+        traces.append({"name": d[0], "x": x, "y": y, "secondary": False})
         if type(dat_index) is not int:
             index = dat_index[1]
-            fig.add_trace(go.Scatter(x=d[1][0], y=d[1][index],
-                                     # mode="lines+markers",
-                                     mode="lines",
-                                     name=d[0]),
-                          secondary_y=True
-                          )
+            x, y = reduce_trace(d[1][0], d[1][index])
+            traces.append({"name": d[0], "x": x, "y": y, "secondary": True})
+    return traces
 
 
-# data = [(country, calculate_statistics(country)) for country in [r[0] for r in residents.values]]
-data = [(country, calculate_statistics(country)) for country in interesting_countries]
+with stage("plot: statistics", len(raw_data)) as computed:
+    statistics = calculate_all_statistics(raw_data)
+    if plot_all_countries:
+        plotted_countries = statistics["confirmed"].index.intersection(residents_by_country.index)
+    else:
+        plotted_countries = [country for country in interesting_countries if country in statistics["confirmed"].index]
+        missing = sorted(set(interesting_countries) - set(plotted_countries))
+        if missing:
+            print("countries without data: " + ", ".join(missing))
+    data = [(country, calculate_statistics(country)) for country in plotted_countries]
+    computed.rows_out = len(statistics["confirmed"])
 
-lines = list()
+figures = list()
 for d in data_indices:
-    # fig = go.Figure()
-    fig = make_subplots(specs=[[{"secondary_y": True}]])
-
-    fig.update_xaxes(title_text="Date")
     if type(d) is not int:
-        add_plot(fig, data, d)
-        label = labels[d[0]]
-        fig.update_yaxes(title_text=label)
-        fig.update_yaxes(title_text=labels[d[1]], secondary_y=True)
-        label += "_"
-        label += labels[d[1]]
+        label = labels[d[0]] + "_" + labels[d[1]]
+        figure = {"yaxis": labels[d[0]], "yaxis2": labels[d[1]]}
     else:
-        add_plot(fig, data, d)
         label = labels[d]
-        fig.update_yaxes(title_text=label)
+        figure = {"yaxis": label}
+    figure.update(name=f"jh_{label}", path=f"../docs/plots/jh_{label}.html", traces=add_plot(data, d))
+    figures.append(figure)
 
-    # fig.show()
-    fig.write_html(f"../docs/plots/jh_{label}.html")
+render_all(figures, "jh")
@@ -6,18 +6,21 @@ Description
 @note:  All rights reserved.
 """
 import json
+import shutil
 
 import numpy as np
 import pandas as pd
 import plotly
-import requests
 from icecream import ic
-from plotly.subplots import make_subplots
-import plotly.graph_objects as go
+
+from downsample import reduce_trace
+from fetch import fetch, sources
+from figures import render_all
+from instrument import stage
 
 # https://www-genesis.destatis.de/genesis/online?operation=abruftabelleBearbeiten&levelindex=1&levelid=1640356498708&auswahloperation=abruftabelleAuspraegungAuswaehlen&auswahlverzeichnis=ordnungsstruktur&auswahlziel=werteabruf&code=12411-0005&auswahltext=&werteabruf=Werteabruf#abreadcrumb
 
-data_uri = "https://www.arcgis.com/sharing/rest/content/items/66876b81065340a4a48710b062319336/data"
+data_uri = sources["rki"]
 # data_uri = "https://services7.arcgis.com/mOBPykOjAyBO2ZKk/arcgis/rest/services/RKI_COVID19/FeatureServer/0/query?where=1%3D1&outFields=*&outSR=4326&f=json&resultOffset={}"
 # data_uri = "https://services7.arcgis.com/mOBPykOjAyBO2ZKk/arcgis/rest/services/RKI_COVID19/FeatureServer/0/query?where=1%3D1&outFields=*&f=json"
 # data_uri = "https://npgeo-corona-npgeo-de.hub.arcgis.com/datasets/dd4580c810204019a7b8eb3e0b329dd6_0/explore?showTable=true"
@@ -38,15 +41,14 @@ for ag in age_group_size:
 
 
 def download_data():
-    with open(rki_file, "w") as fp:
-        fp.writelines([requests.get(data_uri).text])
+    shutil.copyfile(fetch(data_uri), rki_file)
 
 
 def read_csv():
     return pd.read_csv(rki_file, sep=",", parse_dates=['Meldedatum', "Refdatum"])
 
 
-def add_trace(df_filtered, fig, all_time, start_dat, end_dat, value_key, date_key, label, secondary, factor, color):
+def add_trace(df_filtered, traces, all_time, start_dat, end_dat, value_key, date_key, label, secondary, factor, color):
     # aggregate
     df_filtered = df_filtered[df_filtered[value_key] >= 0]
     df_filtered = df_filtered.groupby(date_key)[value_key].sum()
@@ -61,26 +63,16 @@ def add_trace(df_filtered, fig, all_time, start_dat, end_dat, value_key, date_ke
     df_filtered *= factor
     cumsum = np.cumsum(df_filtered.values)
     if all_time:
-        fig.add_trace(go.Scatter(x=df_filtered.keys()[14:].strftime('%Y-%m-%d').values,
-                                 y=cumsum,
-                                 mode="lines",
-                                 name=label,
-                                 marker={"color": color}),
-                      secondary_y=secondary
-                      )
+        x, y = reduce_trace(df_filtered.keys()[14:].strftime('%Y-%m-%d').values, cumsum)
+        traces.append({"name": label, "x": x, "y": y, "secondary": secondary, "color": color})
 
     else:
         # kernel_size = 14
         # kernel = np.ones(kernel_size) / kernel_size
         # data_convolved = np.convolve(df_filtered, kernel, mode='same')
         data_convolved = cumsum[14:] - cumsum[:-14]
-        fig.add_trace(go.Scatter(x=df_filtered.keys().strftime('%Y-%m-%d').values[14:],
-                                 y=data_convolved,
-                                 mode="lines",
-                                 name=label,
-                                 marker={"color": color}),
-                      secondary_y=secondary
-                      )
+        x, y = reduce_trace(df_filtered.keys().strftime('%Y-%m-%d').values[14:], data_convolved)
+        traces.append({"name": label, "x": x, "y": y, "secondary": secondary, "color": color})
         # fig.add_trace(go.Scatter(x=df_filtered.keys().strftime('%Y-%m-%d').values,
         #                          y=df_filtered,
         #                          mode="markers",
@@ -89,11 +81,12 @@ def add_trace(df_filtered, fig, all_time, start_dat, end_dat, value_key, date_ke
         #               )
 
 
-def add_data_to_fig(df, fig, all_time, age, id_bundesland, id_landkreis, typ, secondary, normalize_age=False):
+def add_data_to_fig(df, traces, all_time, age, id_bundesland, id_landkreis, typ, secondary, normalize_age=False):
+    # appends the traces of the filters to traces, df sorted by date
     date_key = "Meldedatum"
     start_dat = np.min(df[date_key].values)
     end_dat = np.max(df[date_key].values)
-    df_filtered = df.sort_values(date_key)
+    df_filtered = df
 
     if typ == "death":
         value_key = "AnzahlTodesfall"
@@ -103,13 +96,13 @@ def add_data_to_fig(df, fig, all_time, age, id_bundesland, id_landkreis, typ, se
     counter = 0
     if not age:
 
-        add_trace(df_filtered, fig, all_time, start_dat, end_dat, value_key, date_key, label, secondary, 1.0, plotly.colors.DEFAULT_PLOTLY_COLORS[-1])
+        add_trace(df_filtered, traces, all_time, start_dat, end_dat, value_key, date_key, label, secondary, 1.0, plotly.colors.DEFAULT_PLOTLY_COLORS[-1])
         if id_bundesland:
             for id in range(1, 17):
                 df_filtered2 = df_filtered[df_filtered["IdBundesland"] == id]
                 color = plotly.colors.DEFAULT_PLOTLY_COLORS[counter % len(plotly.colors.DEFAULT_PLOTLY_COLORS)]
                 counter += 1
-                add_trace(df_filtered2, fig, all_time, start_dat, end_dat, value_key, date_key, f"{label} {df_filtered2.iloc[0]['Bundesland']}", secondary, 1.0, color)
+                add_trace(df_filtered2, traces, all_time, start_dat, end_dat, value_key, date_key, f"{label} {df_filtered2.iloc[0]['Bundesland']}", secondary, 1.0, color)
     else:
         if id_bundesland >= 0:
             df_filtered = df_filtered[df_filtered["IdBundesland"] == id_bundesland]
@@ -119,7 +112,7 @@ def add_data_to_fig(df, fig, all_time, age, id_bundesland, id_landkreis, typ, se
             df_filtered2 = df_filtered[df_filtered["Altersgruppe"] == age_group]
             color = plotly.colors.DEFAULT_PLOTLY_COLORS[counter]
             counter += 1
-            add_trace(df_filtered2, fig, all_time, start_dat, end_dat, value_key, date_key, label + age_group, secondary, age_group_factor[age_group] if normalize_age else 1.0, color)
+            add_trace(df_filtered2, traces, all_time, start_dat, end_dat, value_key, date_key, label + age_group, secondary, age_group_factor[age_group] if normalize_age else 1.0, color)
 
 
 """
@@ -132,96 +125,39 @@ interesting parameters:
 """
 
 
+# the figures: file name, y axis title and the filters of add_data_to_fig;
+# each shows the 14 day sums and (on the secondary axis) the totals
+figures = [
+    {"name": "infected_normalized_age", "title": "Infected normalized", "typ": "inf", "id_landkreis": -1, "id_bundesland": -1, "age": True, "normalize_age": True},
+    {"name": "deaths_normalized_age", "title": "Deaths normalized", "typ": "death", "id_landkreis": -1, "id_bundesland": -1, "age": True, "normalize_age": True},
+    {"name": "deaths_normalized_age_gz", "title": "Deaths Guenzburg normalized", "typ": "death", "id_landkreis": 9774, "id_bundesland": -1, "age": True, "normalize_age": True},
+    {"name": "infected_normalized_age_gz", "title": "Infected Guenzburg normalized", "typ": "inf", "id_landkreis": 9774, "id_bundesland": -1, "age": True, "normalize_age": True},
+    {"name": "infected_age", "title": "Infected", "typ": "inf", "id_landkreis": -1, "id_bundesland": -1, "age": True},
+    {"name": "deaths_age", "title": "Deaths", "typ": "death", "id_landkreis": -1, "id_bundesland": -1, "age": True},
+    {"name": "deaths_age_gz", "title": "Deaths Guenzburg", "typ": "death", "id_landkreis": 9774, "id_bundesland": -1, "age": True},
+    {"name": "infected", "title": "Infected Bundesländer", "typ": "inf", "id_landkreis": -1, "id_bundesland": True, "age": False},
+    {"name": "deaths", "title": "Tote Bundesländer", "typ": "death", "id_landkreis": -1, "id_bundesland": True, "age": False},
+]
+
+
 def plot(df):
-    fig = make_subplots(specs=[[{"secondary_y": True}]])
-    fig.update_xaxes(title_text="Date")
-    fig.update_yaxes(title_text="Infected normalized")
-    add_data_to_fig(df, fig, all_time=False, id_landkreis=-1, id_bundesland=-1, age=True, typ="inf", secondary=False, normalize_age=True)
-    add_data_to_fig(df, fig, all_time=True, id_landkreis=-1, id_bundesland=-1, age=True, typ="inf", secondary=True, normalize_age=True)
-    # fig.show()
-    label = "infected_normalized_age"
-    fig.write_html(f"../docs/plots/rki_{label}.html")
-
-    fig = make_subplots(specs=[[{"secondary_y": True}]])
-    fig.update_xaxes(title_text="Date")
-    fig.update_yaxes(title_text="Deaths normalized")
-    add_data_to_fig(df, fig, all_time=False, id_landkreis=-1, id_bundesland=-1, age=True, typ="death", secondary=False, normalize_age=True)
-    add_data_to_fig(df, fig, all_time=True, id_landkreis=-1, id_bundesland=-1, age=True, typ="death", secondary=True, normalize_age=True)
-    # fig.show()
-    label = "deaths_normalized_age"
-    fig.write_html(f"../docs/plots/rki_{label}.html")
-
-    fig = make_subplots(specs=[[{"secondary_y": True}]])
-    fig.update_xaxes(title_text="Date")
-    fig.update_yaxes(title_text="Deaths Guenzburg normalized")
-    add_data_to_fig(df, fig, all_time=False, id_landkreis=9774, id_bundesland=-1, age=True, typ="death", secondary=False, normalize_age=True)
-    add_data_to_fig(df, fig, all_time=True, id_landkreis=9774, id_bundesland=-1, age=True, typ="death", secondary=True, normalize_age=True)
-    # fig.show()
-    label = "deaths_normalized_age_gz"
-    fig.write_html(f"../docs/plots/rki_{label}.html")
-
-    fig = make_subplots(specs=[[{"secondary_y": True}]])
-    fig.update_xaxes(title_text="Date")
-    fig.update_yaxes(title_text="Infected Guenzburg normalized")
-    add_data_to_fig(df, fig, all_time=False, id_landkreis=9774, id_bundesland=-1, age=True, typ="inf", secondary=False, normalize_age=True)
-    add_data_to_fig(df, fig, all_time=True, id_landkreis=9774, id_bundesland=-1, age=True, typ="inf", secondary=True, normalize_age=True)
-    # fig.show()
-    label = "infected_normalized_age_gz"
-    fig.write_html(f"../docs/plots/rki_{label}.html")
-
-    fig = make_subplots(specs=[[{"secondary_y": True}]])
-    fig.update_xaxes(title_text="Date")
-    fig.update_yaxes(title_text="Infected")
-    add_data_to_fig(df, fig, all_time=False, id_landkreis=-1, id_bundesland=-1, age=True, typ="inf", secondary=False)
-    add_data_to_fig(df, fig, all_time=True, id_landkreis=-1, id_bundesland=-1, age=True, typ="inf", secondary=True)
-    # fig.show()
-    label = "infected_age"
-    fig.write_html(f"../docs/plots/rki_{label}.html")
-
-    fig = make_subplots(specs=[[{"secondary_y": True}]])
-    fig.update_xaxes(title_text="Date")
-    fig.update_yaxes(title_text="Deaths")
-    add_data_to_fig(df, fig, all_time=False, id_landkreis=-1, id_bundesland=-1, age=True, typ="death", secondary=False)
-    add_data_to_fig(df, fig, all_time=True, id_landkreis=-1, id_bundesland=-1, age=True, typ="death", secondary=True)
-    # fig.show()
-    label = "deaths_age"
-    fig.write_html(f"../docs/plots/rki_{label}.html")
-
-    fig = make_subplots(specs=[[{"secondary_y": True}]])
-    fig.update_xaxes(title_text="Date")
-    fig.update_yaxes(title_text="Deaths Guenzburg")
-    add_data_to_fig(df, fig, all_time=False, id_landkreis=9774, id_bundesland=-1, age=True, typ="death", secondary=False)
-    add_data_to_fig(df, fig, all_time=True, id_landkreis=9774, id_bundesland=-1, age=True, typ="death", secondary=True)
-    # fig.show()
-    label = "deaths_age_gz"
-    fig.write_html(f"../docs/plots/rki_{label}.html")
-
-    fig = make_subplots(specs=[[{"secondary_y": True}]])
-    fig.update_xaxes(title_text="Date")
-    fig.update_yaxes(title_text="Infected Guenzburg")
-    add_data_to_fig(df, fig, all_time=False, id_landkreis=9774, id_bundesland=-1, age=True, typ="inf", secondary=False)
-    add_data_to_fig(df, fig, all_time=True, id_landkreis=9774, id_bundesland=-1, age=True, typ="inf", secondary=True)
-    # fig.show()
-
-    fig = make_subplots(specs=[[{"secondary_y": True}]])
-    fig.update_xaxes(title_text="Date")
-    fig.update_yaxes(title_text="Infected Bundesländer")
-    add_data_to_fig(df, fig, all_time=False, id_landkreis=-1, id_bundesland=True, age=False, typ="inf", secondary=False)
-    add_data_to_fig(df, fig, all_time=True, id_landkreis=-1, id_bundesland=True, age=False, typ="inf", secondary=True)
-    # fig.show()
-    label = "infected"
-    fig.write_html(f"../docs/plots/rki_{label}.html")
-
-    fig = make_subplots(specs=[[{"secondary_y": True}]])
-    fig.update_xaxes(title_text="Date")
-    fig.update_yaxes(title_text="Tote Bundesländer")
-    add_data_to_fig(df, fig, all_time=False, id_landkreis=-1, id_bundesland=True, age=False, typ="death", secondary=False)
-    add_data_to_fig(df, fig, all_time=True, id_landkreis=-1, id_bundesland=True, age=False, typ="death", secondary=True)
-    # fig.show()
-    label = "deaths"
-    fig.write_html(f"../docs/plots/rki_{label}.html")
-
-
-ic(download_data())
-df = read_csv()
+    # aggregates the traces of all figures here, renders them in parallel
+    df = df.sort_values("Meldedatum")
+    specs = []
+    for figure in figures:
+        with stage(f"rki: {figure['name']}") as aggregated:
+            filters = {key: value for key, value in figure.items() if key not in ("name", "title")}
+            traces = []
+            add_data_to_fig(df, traces, all_time=False, secondary=False, **filters)
+            add_data_to_fig(df, traces, all_time=True, secondary=True, **filters)
+            aggregated.rows_out = len(traces)
+        specs.append({"name": f"rki_{figure['name']}", "path": f"../docs/plots/rki_{figure['name']}.html", "yaxis": figure["title"], "traces": traces})
+    render_all(specs, "rki")
+
+
+with stage("rki: download"):
+    ic(download_data())
+with stage("rki: parse") as parsed:
+    df = read_csv()
+    parsed.rows_out = len(df)
 ic(plot(df))
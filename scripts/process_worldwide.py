@@ -1,322 +1,452 @@
+import hashlib
+import json
+import os
+from functools import cached_property
+
 import pandas as pd
 import numpy as np
 
+from dates import normalize_dates
+from fetch import read_all, sources
+from instrument import stage
+from output import append_dataset, columnar_formats, write_dataset
+
+
+def calculate_increase_rate(confirmed, previous):
+    # day-over-day growth of the confirmed cases in percent, empty where there
+    # were no cases the day before
+    previous = previous.where(previous != 0)
+    return (confirmed - previous) / previous * 100
+
+
+def add_derived_metrics(data, by: str = "Country"):
+    # Daily new cases/deaths, their 7-day rolling averages and the increase
+    # rate for a long table with the dates in order per group, computed for
+    # all groups at once.
+    grouped = data.groupby(by, sort=False)
+    previous = grouped[["Confirmed", "Deaths"]].shift()
+    data["New cases"] = data["Confirmed"] - previous["Confirmed"]
+    data["New deaths"] = data["Deaths"] - previous["Deaths"]
+    data[["New cases", "New deaths"]] = data[
+        ["New cases", "New deaths"]
+    ].astype("Int64")
+
+    new = data[["New cases", "New deaths"]].astype(float)
+    rolling = new.groupby(data[by], sort=False).rolling(7).mean()
+    rolling.index = rolling.index.droplevel(0)
+    data["New cases 7d avg"] = rolling["New cases"]
+    data["New deaths 7d avg"] = rolling["New deaths"]
+
+    data["Increase rate"] = calculate_increase_rate(
+        data["Confirmed"], previous["Confirmed"]
+    )
+    return data
+
+
+def roll_up_provinces(df):
+    # Sum the province rows of every country into a single country row. One
+    # grouped aggregation instead of a drop/append per split-up country.
+    dates = df.columns.drop(
+        ["Province/State", "Country/Region", "Lat", "Long"], errors="ignore"
+    )
+    return df.groupby("Country/Region", sort=False, as_index=False)[
+        list(dates)
+    ].sum()
+
+
+def melt_countries(df, value_name):
+    # wide country table (one column per date) -> (Country/Region, Date, value)
+    return df.melt(
+        id_vars="Country/Region", var_name="Date", value_name=value_name
+    )
+
 
-def calculate_increase_rate(csv_file: str = "data/worldwide-aggregate.csv"):
-    with open(csv_file) as read_file:
-        rows = read_file.read().splitlines()
-    with open(csv_file, "w") as write_file:
-        header_row = rows[0] + ",Increase rate"
-        write_file.write(f"{header_row}\n")
-        previous_row = None
-        for row in rows[1:]:  # exclude header row
-            if previous_row:
-                prev_confirmed = int(previous_row.split(",")[1])
-                confirmed = int(row.split(",")[1])
-                rate = (confirmed - prev_confirmed) / prev_confirmed * 100
-                write_file.write(f"{row},{rate}\n")
-            else:
-                write_file.write(f"{row},\n")
-            previous_row = row
-
-
-def adjust_date(s):
-    l = s.split("/")
-    return f"20{l[2]}-{int(l[0]):02d}-{int(l[1]):02d}"
-
-
-base_url = "https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/"
-confirmed_url = "time_series_covid19_confirmed_global.csv"
-dead_url = "time_series_covid19_deaths_global.csv"
-recovered_url = "time_series_covid19_recovered_global.csv"
-
-
-print("===============\nWorking on basic time series\n")
-
-df = pd.read_csv(base_url + confirmed_url)
-confirmed_copy = df.copy()  # for time series file with provinces
-df = df.drop(["Lat", "Long"], axis=1)
-
-to_concat = df[df["Province/State"].notna()]["Country/Region"].unique()
-# We have to combine the numbers from the countries that are split up into
-# provinces
-for country in to_concat:
-    new_row = df[df["Country/Region"] == country].sum()
-    new_row["Country/Region"] = country
-    new_row["Province/State"] = np.NaN
-    df = df.drop(df[df["Country/Region"] == country].index)
-    df = df.append(new_row, ignore_index=True)
-
-confirmed = df[df["Province/State"].isna()].drop(
-    "Province/State", axis=1
-)  # take only countries (no territories)
-# print(to_concat)
-
-df = pd.read_csv(base_url + dead_url)
-dead_copy = df.copy()  # for time series file with provinces
-df = df.drop(["Lat", "Long"], axis=1)
-to_concat = df[df["Province/State"].notna()]["Country/Region"].unique()
-for country in to_concat:
-    new_row = df[df["Country/Region"] == country].sum()
-    new_row["Country/Region"] = country
-    new_row["Province/State"] = np.NaN
-    df = df.drop(df[df["Country/Region"] == country].index)
-    df = df.append(new_row, ignore_index=True)
-
-dead = df[df["Province/State"].isna()].drop(
-    "Province/State", axis=1
-)  # take only countries (no territories)
-
-# make sure all values in the column are strings (np.NaN is a float)
-confirmed["Country/Region"] = confirmed["Country/Region"].fillna("")
-dead["Country/Region"] = dead["Country/Region"].fillna("")
-
-df = pd.read_csv(base_url + recovered_url)
-recovered_copy = df.copy()  # for time series
-df = df.drop(["Lat", "Long"], axis=1)
-to_concat = df[df["Province/State"].notna()]["Country/Region"].unique()
-for country in to_concat:
-    new_row = df[df["Country/Region"] == country].sum()
-    new_row["Country/Region"] = country
-    new_row["Province/State"] = np.NaN
-    df = df.drop(df[df["Country/Region"] == country].index)
-    df = df.append(new_row, ignore_index=True)
-
-recovered = df[df["Province/State"].isna()].drop(
-    "Province/State", axis=1
-)  # take only countries (no territories)
-
-dates = np.intersect1d(
-    np.intersect1d(
-        confirmed.drop("Country/Region", axis=1).columns, dead.columns
-    ),
-    recovered.columns,
-)
-df = df[df["Province/State"].isna()].drop(
-    "Province/State", axis=1
-)  # take only countries (no territories)
-countries = np.intersect1d(
-    np.intersect1d(
+def build_countries_aggregated(
+    confirmed, dead, recovered, chronological: bool = True
+):
+    # Long format of the rolled-up country tables: every table is melted once
+    # and the three are joined on (Country, Date). With chronological=True the
+    # rows are grouped per country with the dates in order (as in the
+    # published file), otherwise they stay in the melted date-major order.
+    countries = np.intersect1d(
         confirmed["Country/Region"].unique(), dead["Country/Region"].unique()
-    ),
-    confirmed["Country/Region"].unique(),
-)
-
-
-data = pd.DataFrame()
-for country in countries:
-    # confirmed cases
-    cntry_c = (
-        confirmed[confirmed["Country/Region"] == country]
-        .transpose()
-        .drop("Country/Region")
     )
-    cntry_c.columns = ["Confirmed"]
-    cntry_c["Date"] = cntry_c.index
-
-    # total deaths
-    cntry_d = (
-        dead[dead["Country/Region"] == country]
-        .transpose()
-        .drop("Country/Region")
+    key = ["Country/Region", "Date"]
+    data = melt_countries(
+        confirmed[confirmed["Country/Region"].isin(countries)], "Confirmed"
     )
-    cntry_d.columns = ["Deaths"]
-    cntry_d["Date"] = cntry_d.index
-
-    # recovered
-    cntry_r = (
-        recovered[recovered["Country/Region"] == country]
-        .transpose()
-        .drop("Country/Region")
+    data = data.merge(melt_countries(dead, "Deaths"), how="left", on=key)
+    data = data.merge(
+        melt_countries(recovered, "Recovered"), how="left", on=key
     )
-    cntry_r.columns = ["Recovered"]
-    cntry_r["Date"] = cntry_r.index
-
-    # concatenate (not the best way)
-    cntry = cntry_c
-    cntry["Deaths"] = cntry_d["Deaths"]
-    cntry["Recovered"] = cntry_r["Recovered"]
-
-    cntry = cntry.reset_index(drop=True)
-    cntry["Country"] = country
-    # print(cntry)
-    data = data.append(
-        cntry[["Date", "Country", "Confirmed", "Recovered", "Deaths"]]
+    # keep integer formatting in the csv even where the join left gaps
+    data[["Recovered", "Deaths"]] = data[["Recovered", "Deaths"]].astype(
+        "Int64"
     )
+    if chronological:
+        # stable sort keeps the column (= date) order within each country
+        data = data.sort_values("Country/Region", kind="mergesort")
+    data = data.rename(columns={"Country/Region": "Country"})
+    data["Date"] = normalize_dates(data["Date"])
+    return data[["Date", "Country", "Confirmed", "Recovered", "Deaths"]]
+
+
+def index_by_location(df):
+    # wide table indexed by the (Country/Region, Province/State) key
+    df = df.drop(["Lat", "Long"], axis=1)
+    df["Province/State"] = df["Province/State"].fillna("")
+    return df.set_index(["Country/Region", "Province/State"])
+
+
+def build_time_series(confirmed, dead, recovered, chronological: bool = True):
+    # Long format per country-province combination. All tables are indexed
+    # by the location key once and aligned on the confirmed rows, i.e. left
+    # joined: combos a table does not report become NaN (Canada doesn't
+    # report recovered at a province level). chronological as in
+    # build_countries_aggregated.
+    confirmed = index_by_location(confirmed)
+    dates = confirmed.columns
+    dead = index_by_location(dead).reindex(
+        index=confirmed.index, columns=dates
+    )
+    recovered = index_by_location(recovered).reindex(
+        index=confirmed.index, columns=dates
+    )
+
+    if chronological:
+        # row-major ravel: every combo with its dates in order
+        order = "C"
+        date_col = np.tile(dates.values, len(confirmed))
+        countries = confirmed.index.get_level_values(0).repeat(len(dates))
+        provinces = confirmed.index.get_level_values(1).repeat(len(dates))
+    else:
+        # column-major ravel: all combos of a date, date after date
+        order = "F"
+        date_col = dates.values.repeat(len(confirmed))
+        countries = np.tile(confirmed.index.get_level_values(0), len(dates))
+        provinces = np.tile(confirmed.index.get_level_values(1), len(dates))
+    data = pd.DataFrame(
+        {
+            "Date": date_col,
+            "Country/Region": countries,
+            "Province/State": provinces,
+            "Confirmed": confirmed.to_numpy().ravel(order),
+            "Recovered": recovered.to_numpy().ravel(order),
+            "Deaths": dead.to_numpy().ravel(order),
+        }
+    )
+    data[["Recovered", "Deaths"]] = data[["Recovered", "Deaths"]].astype(
+        "Int64"
+    )
+    data["Date"] = normalize_dates(data["Date"])
+    return data
 
 
-data["Date"] = data["Date"].map(adjust_date)
-data = data.reset_index(drop=True)
-data.to_csv("data/countries-aggregated.csv", index=False)
+def build_key_countries(confirmed):
+    # confirmed cases of the key countries, one column per country
+    key_countries = confirmed[
+        confirmed["Country/Region"].isin(
+            [
+                "US",
+                "China",
+                "United Kingdom",
+                "Italy",
+                "France",
+                "Germany",
+                "Spain",
+                "Iran",
+            ]
+        )
+    ]
+    key_countries = key_countries.transpose()
+    key_countries.columns = key_countries.iloc[0]
+    key_countries = key_countries.drop("Country/Region")
+    key_countries["Date"] = key_countries.index
+    key_countries["Date"] = normalize_dates(key_countries["Date"])
+    key_countries = key_countries.rename(
+        {"United Kingdom": "United_Kingdom"}, axis="columns"
+    )
+    return key_countries[
+        [
+            "Date",
+            "China",
+            "US",
+            "United_Kingdom",
+            "Italy",
+            "France",
+            "Germany",
+            "Spain",
+            "Iran",
+        ]
+    ]
 
 
-# ============================================================================
-# Now create the more detailed time series
-print("\n===============\nWorking on more detailed time series\n")
+def build_world_aggregate(confirmed, dead, recovered):
+    # works on the raw as well as on the rolled-up tables
+    df = pd.DataFrame()
+    df["Confirmed"] = confirmed[date_columns(confirmed)].sum()
+    df["Recovered"] = recovered[date_columns(recovered)].sum()
+    df["Deaths"] = dead[date_columns(dead)].sum()
+    df["Date"] = df.index
+    df["Date"] = normalize_dates(df["Date"])
+    df = df[["Date", "Confirmed", "Recovered", "Deaths"]]
+    df["Increase rate"] = calculate_increase_rate(
+        df["Confirmed"], df["Confirmed"].shift()
+    )
+    return df
+
+
+class WorldwidePipeline:
+    # All outputs of this script from the three JHU tables. Every table is
+    # parsed once, the intermediates (rolled-up countries, long time series)
+    # are computed on first use and shared by the outputs.
+
+    def __init__(
+        self,
+        confirmed,
+        dead,
+        recovered,
+        chronological: bool = True,
+        country_metrics: bool = False,
+    ):
+        self.tables = {
+            "confirmed": confirmed,
+            "dead": dead,
+            "recovered": recovered,
+        }
+        self.chronological = chronological
+        self.country_metrics = country_metrics
+
+    @classmethod
+    def from_upstream(cls, **kwargs):
+        tables = read_all(
+            {
+                "confirmed": sources["confirmed_global"],
+                "dead": sources["deaths_global"],
+                "recovered": sources["recovered_global"],
+            }
+        )
+        return cls(**tables, **kwargs)
+
+    def window(self, dates):
+        # the same pipeline restricted to some date columns
+        location = ["Province/State", "Country/Region", "Lat", "Long"]
+        return WorldwidePipeline(
+            *(df[location + list(dates)] for df in self.tables.values()),
+            chronological=self.chronological,
+            country_metrics=self.country_metrics,
+        )
+
+    @cached_property
+    def countries(self):
+        # We have to combine the numbers from the countries that are split
+        # up into provinces
+        return {
+            name: roll_up_provinces(df) for name, df in self.tables.items()
+        }
+
+    @cached_property
+    def countries_aggregated(self):
+        data = build_countries_aggregated(
+            self.countries["confirmed"],
+            self.countries["dead"],
+            self.countries["recovered"],
+            self.chronological,
+        )
+        if self.country_metrics:
+            data = add_derived_metrics(data)
+        return data
+
+    @cached_property
+    def time_series(self):
+        return build_time_series(
+            self.tables["confirmed"],
+            self.tables["dead"],
+            self.tables["recovered"],
+            self.chronological,
+        )
+
+    @cached_property
+    def key_countries(self):
+        return build_key_countries(self.countries["confirmed"])
+
+    @cached_property
+    def world_aggregate(self):
+        return build_world_aggregate(
+            self.countries["confirmed"],
+            self.countries["dead"],
+            self.countries["recovered"],
+        )
+
+    def build(self, name):
+        # one of the tables above, measured as a stage
+        with stage(f"worldwide: {name}") as built:
+            data = getattr(self, name)
+            built.rows_out = len(data)
+        return data
+
+    def outputs(self):
+        rows_in = sum(len(df) for df in self.tables.values())
+        with stage("worldwide: roll-up", rows_in) as rolled_up:
+            rolled_up.rows_out = sum(len(df) for df in self.countries.values())
+        print("===============\nWorking on basic time series\n")
+        outputs = {
+            "data/countries-aggregated.csv": self.build("countries_aggregated")
+        }
+        print("\n===============\nWorking on more detailed time series\n")
+        outputs["data/time-series-19-covid-combined.csv"] = self.build(
+            "time_series"
+        )
+        print("\n===============\nWorking on Key Countries\n")
+        outputs["data/key-countries-pivoted.csv"] = self.build("key_countries")
+        print("\n===============\nWorking on world aggregate\n")
+        outputs["data/worldwide-aggregate.csv"] = self.build("world_aggregate")
+        return outputs
+
+
+def date_columns(df):
+    return df.columns.drop(
+        ["Province/State", "Country/Region", "Lat", "Long"], errors="ignore"
+    )
 
-confirmed = confirmed_copy.copy()
-confirmed["Province/State"] = confirmed["Province/State"].fillna("")
-dead = dead_copy.copy()
-dead["Province/State"] = dead["Province/State"].fillna("")
-recovered = recovered_copy.copy()
-recovered["Province/State"] = recovered["Province/State"].fillna("")
 
-# these are the country-province combinations, we go through them to
-# reformat the columns
-combos = np.array(
-    confirmed[["Country/Region", "Province/State"]].to_records(index=False)
-)
+def column_checksums(df, columns):
+    # one checksum per date column, plus one for the locations (rows)
+    checksums = {
+        "locations": hash_values(df[["Province/State", "Country/Region"]])
+    }
+    for column in columns:
+        checksums[column] = hash_values(df[column])
+    return checksums
 
-data = pd.DataFrame()
-for country, state in combos:
 
-    # Here we just need to check if we are dealing with a country-province
-    # or just a country
-    is_na = False
-    if state == "":
-        is_na = True
+def hash_values(values):
+    hashed = pd.util.hash_pandas_object(values, index=False)
+    return hashlib.sha1(hashed.to_numpy().tobytes()).hexdigest()
 
-    df_c = confirmed[
-        (confirmed["Country/Region"] == country)
-        & ((confirmed["Province/State"] == state))
-    ]
 
+def load_state():
     try:
-        Lat, Long = df_c["Lat"].values[0], df_c["Long"].values[0]
-    except IndexError:
-        print("  Skipping, Index Error")
-        continue
-    except Exception as e:
-        raise (e)
-    # print(Lat, Long)
-
-    df_r = recovered.loc[
-        (recovered["Country/Region"] == country)
-        & ((recovered["Province/State"] == state))
-    ].transpose()
-    df_r = df_r.drop(["Province/State", "Country/Region", "Lat", "Long"])
-
-    # Canada is annoying and doesn't report recovered at a province level
-    try:
-        df_r.columns = ["Recovered"]
-    except:
-        df_r["Recovered"] = np.NaN  # May change this to the empty string
-
-    df_c = df_c.transpose().drop(
-        ["Province/State", "Country/Region", "Lat", "Long"]
-    )
-    df_c.columns = ["Confirmed"]
-
-    df_d = dead[
-        (dead["Country/Region"] == country)
-        & ((dead["Province/State"] == state))
-    ].transpose()
-    df_d = df_d.drop(["Province/State", "Country/Region", "Lat", "Long"])
-    df_d.columns = ["Deaths"]
-
-    df = df_c
-    df["Recovered"] = df_r["Recovered"]
-    df["Deaths"] = df_d["Deaths"]
-    df["Country/Region"] = country
-    df["Province/State"] = state
-    df["Date"] = df.index
+        with open(state_file) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def output_settings():
+    # what decides the columns and files of the outputs; appending to outputs
+    # written with other settings would mix up their columns
+    return {
+        "country_metrics": country_metrics,
+        "columnar_formats": columnar_formats,
+    }
+
+
+def save_state(last_date, tables):
+    state = {
+        "last_date": last_date,
+        "settings": output_settings(),
+        "checksums": {
+            name: column_checksums(df, date_columns(df))
+            for name, df in tables.items()
+        },
+        "sizes": {path: os.path.getsize(path) for path in output_files},
+    }
+    tmp_path = state_file + ".tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(state, fp, indent=2)
+    os.replace(tmp_path, state_file)
+
+
+def find_new_dates(state, tables):
+    # Date columns added upstream since the last run, or None if history
+    # has to be rebuilt: no/unknown state, other output settings, touched
+    # output files, changed locations or revised values in an already
+    # processed column. A date some table doesn't have yet (e.g. recovered
+    # lagging behind confirmed) and the ones after it wait for a later run.
+    if state is None:
+        return None
+    if state.get("settings") != output_settings():
+        print("  output settings changed since the last run, rebuilding")
+        return None
+    for path, size in state["sizes"].items():
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            print(f"  {path} changed since the last run")
+            return None
+    dates = date_columns(tables["confirmed"])
+    if state["last_date"] not in dates:
+        return None
+    processed = dates[: dates.get_loc(state["last_date"]) + 1]
+    for name, df in tables.items():
+        if name not in state["checksums"]:
+            return None
+        if any(column not in df.columns for column in processed):
+            return None
+        new = column_checksums(df, processed)
+        old = state["checksums"][name]
+        if new != {column: old.get(column) for column in new}:
+            print(f"  upstream revised {name}, rebuilding")
+            return None
+    new_dates = dates[len(processed) :]
+    for df in tables.values():
+        lagging = np.flatnonzero(~new_dates.isin(df.columns))
+        if len(lagging):
+            new_dates = new_dates[: lagging[0]]
+    return new_dates
+
+
+# add new cases/deaths, 7-day averages and increase rate per country to
+# countries-aggregated.csv (COVID_COUNTRY_METRICS=1)
+country_metrics = os.environ.get("COVID_COUNTRY_METRICS", "") not in ("", "0")
+
+# With COVID_INCREMENTAL=1, only process date columns published since the
+# last run and append their rows to the outputs. The long files are then
+# ordered date by date instead of country by country. History is rebuilt if
+# upstream revised it.
+incremental = os.environ.get("COVID_INCREMENTAL", "") not in ("", "0")
+state_file = "data/.process_worldwide_state.json"
+# previous dates recomputed along with the new ones for the rolling metrics
+context_days = 7
+output_files = [
+    "data/countries-aggregated.csv",
+    "data/time-series-19-covid-combined.csv",
+    "data/key-countries-pivoted.csv",
+    "data/worldwide-aggregate.csv",
+]
 
-    data = data.append(
-        df[
-            [
-                "Date",
-                "Country/Region",
-                "Province/State",
-                "Confirmed",
-                "Recovered",
-                "Deaths",
-            ]
-        ]
-    )
 
-data["Date"] = data.index
-data["Date"] = data["Date"].map(adjust_date)
-data = data.reset_index(drop=True)
-data.to_csv("data/time-series-19-covid-combined.csv", index=False)
-
-
-# ============================================================================
-# Now create the key countries pivoted
-print("\n===============\nWorking on Key Countries\n")
-confirmed = confirmed_copy.copy()
-confirmed["Province/State"] = confirmed["Province/State"]
-
-to_concat = confirmed[confirmed["Province/State"].notna()][
-    "Country/Region"
-].unique()
-# We have to combine the numbers from the countries that are split up into
-# provinces
-for country in to_concat:
-    new_row = confirmed[confirmed["Country/Region"] == country].sum()
-    new_row["Country/Region"] = country
-    new_row["Province/State"] = np.NaN
-    confirmed = confirmed.drop(
-        confirmed[confirmed["Country/Region"] == country].index
+def main():
+    pipeline = WorldwidePipeline.from_upstream(
+        chronological=not incremental, country_metrics=country_metrics
     )
-    confirmed = confirmed.append(new_row, ignore_index=True)
-
-confirmed = confirmed[confirmed["Province/State"].isna()].drop(
-    ["Province/State", "Lat", "Long"], axis=1
-)  # take only countries (no territories)
-key_countries = confirmed[
-    (confirmed["Country/Region"] == "US")
-    | (confirmed["Country/Region"] == "China")
-    | (confirmed["Country/Region"] == "United Kingdom")
-    | (confirmed["Country/Region"] == "Italy")
-    | (confirmed["Country/Region"] == "France")
-    | (confirmed["Country/Region"] == "Germany")
-    | (confirmed["Country/Region"] == "Spain")
-    | (confirmed["Country/Region"] == "Iran")
-]
-key_countries = key_countries.transpose()
-key_countries.columns = key_countries.iloc[0]
-key_countries = key_countries.drop("Country/Region")
-key_countries["Date"] = key_countries.index
-key_countries["Date"] = key_countries["Date"].map(adjust_date)
-key_countries = key_countries.rename(
-    {"United Kingdom": "United_Kingdom"}, axis="columns"
-)
-key_countries = key_countries[
-    [
-        "Date",
-        "China",
-        "US",
-        "United_Kingdom",
-        "Italy",
-        "France",
-        "Germany",
-        "Spain",
-        "Iran",
-    ]
-]
-key_countries.to_csv("data/key-countries-pivoted.csv", index=False)
-
-
-# ============================================================================
-# Now create the world aggregate
-print("\n===============\nWorking on world aggregate\n")
-confirmed = confirmed_copy.copy().drop(
-    ["Lat", "Long", "Province/State", "Country/Region"], axis=1
-)
-dead = dead_copy.copy().drop(
-    ["Lat", "Long", "Province/State", "Country/Region"], axis=1
-)
-recovered = recovered_copy.copy().drop(
-    ["Lat", "Long", "Province/State", "Country/Region"], axis=1
-)
-
-df = pd.DataFrame()
-df["Confirmed"] = confirmed.sum()
-df["Recovered"] = recovered.sum()
-df["Deaths"] = dead.sum()
-df["Date"] = df.index
-df["Date"] = df["Date"].map(adjust_date)
-df = df[["Date", "Confirmed", "Recovered", "Deaths"]]
-df.to_csv("data/worldwide-aggregate.csv", index=False)
-
-calculate_increase_rate()
+    tables = pipeline.tables
+
+    state = load_state() if incremental else None
+    new_dates = find_new_dates(state, tables) if incremental else None
+    dates = date_columns(tables["confirmed"])
+    if new_dates is None:
+        last_date = dates[-1]
+        for path, data in pipeline.outputs().items():
+            with stage(f"worldwide: write {path}", len(data)):
+                write_dataset(data, path)
+    elif len(new_dates):
+        print(f"Appending {len(new_dates)} new dates\n")
+        last_date = new_dates[-1]
+        start = max(dates.get_loc(new_dates[0]) - context_days, 0)
+        stop = dates.get_loc(last_date) + 1
+        outputs = pipeline.window(dates[start:stop]).outputs()
+        new_iso = normalize_dates(pd.Series(new_dates))
+        for path, data in outputs.items():
+            data = data[data["Date"].isin(new_iso)]
+            with stage(f"worldwide: append {path}", len(data)):
+                append_dataset(data, path)
+    else:
+        print("No new dates")
+        last_date = state["last_date"]
+
+    if incremental:
+        save_state(last_date, tables)
+
+
+if __name__ == "__main__":
+    main()
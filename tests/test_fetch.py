@@ -0,0 +1,124 @@
+"""
+Tests fetch.py against a local stand-in for upstream: revalidation with
+ETag / 304, offline mode and retries of 5xx answers.
+
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(repo, "scripts"))
+
+import fetch  # noqa: E402
+
+body = b"Date,Confirmed\n2020-01-22,1\n"
+etag = '"v1"'
+
+
+class Upstream(BaseHTTPRequestHandler):
+    # /data.csv with an ETag; /flaky.csv fails with 503 as often as the
+    # server's failures say first; /missing.csv is a 404
+    def do_GET(self):
+        self.server.requests.append(
+            (self.path, self.headers.get("If-None-Match"))
+        )
+        if self.path == "/flaky.csv" and self.server.failures > 0:
+            self.server.failures -= 1
+            self.send_error(503)
+        elif self.path == "/missing.csv":
+            self.send_error(404)
+        elif self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Upstream)
+        self.server.requests = []
+        self.server.failures = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.cache = tempfile.mkdtemp()
+        self.backoff = fetch.backoff
+        fetch.backoff = 0
+
+    def tearDown(self):
+        fetch.backoff = self.backoff
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache)
+
+    def get(self, name, **kwargs):
+        return fetch.fetch(
+            f"{self.url}/{name}",
+            directory=self.cache,
+            offline_only=False,
+            **kwargs,
+        )
+
+    def test_not_modified_reuses_cache(self):
+        path = self.get("data.csv")
+        mtime = os.stat(path).st_mtime_ns
+        self.assertEqual(self.get("data.csv"), path)
+        with open(path, "rb") as fp:
+            self.assertEqual(fp.read(), body)
+        self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+        self.assertEqual(
+            self.server.requests,
+            [("/data.csv", None), ("/data.csv", etag)],
+        )
+
+    def test_offline_uses_cache_only(self):
+        path = self.get("data.csv")
+        url = f"{self.url}/data.csv"
+        cached = fetch.fetch(url, directory=self.cache, offline_only=True)
+        self.assertEqual(cached, path)
+        self.assertEqual(len(self.server.requests), 1)
+        with self.assertRaises(fetch.FetchError):
+            fetch.fetch(
+                f"{self.url}/other.csv",
+                directory=self.cache,
+                offline_only=True,
+            )
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_server_errors_are_retried(self):
+        self.server.failures = fetch.retries
+        with open(self.get("flaky.csv"), "rb") as fp:
+            self.assertEqual(fp.read(), body)
+        self.assertEqual(len(self.server.requests), fetch.retries + 1)
+
+    def test_gives_up_after_retries(self):
+        self.server.failures = fetch.retries + 1
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            self.get("flaky.csv")
+        self.assertEqual(raised.exception.code, 503)
+        self.assertEqual(len(self.server.requests), fetch.retries + 1)
+
+    def test_client_errors_are_not_retried(self):
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            self.get("missing.csv")
+        self.assertEqual(raised.exception.code, 404)
+        self.assertEqual(len(self.server.requests), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+"""
+Tests the incremental mode of process_worldwide.py (COVID_INCREMENTAL=1) on
+synthetic JHU tables: appended dates, rebuilds after upstream revisions and
+tables lagging behind the others.
+
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import pandas as pd
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(repo, "scripts"))
+sys.path.insert(0, os.path.join(repo, "benchmarks"))
+
+import fetch  # noqa: E402
+import output  # noqa: E402
+import process_worldwide  # noqa: E402
+import synthetic  # noqa: E402
+
+n_days = 12
+aggregated = process_worldwide.output_files[0]
+names = {
+    "confirmed": "confirmed_global",
+    "dead": "deaths_global",
+    "recovered": "recovered_global",
+}
+
+
+class IncrementalTest(unittest.TestCase):
+    def setUp(self):
+        self.tables = synthetic.global_tables(25, n_days, n_split=2)
+        self.cwd = os.getcwd()
+        self.saved = (
+            dict(fetch.sources),
+            process_worldwide.incremental,
+            process_worldwide.country_metrics,
+            process_worldwide.columnar_formats,
+            output.columnar_formats,
+        )
+        process_worldwide.incremental = True
+        process_worldwide.country_metrics = True
+        # the columnar copies are rewritten in full, only the csv is appended
+        process_worldwide.columnar_formats = output.columnar_formats = []
+        self.directories = []
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        (
+            sources,
+            process_worldwide.incremental,
+            process_worldwide.country_metrics,
+            process_worldwide.columnar_formats,
+            output.columnar_formats,
+        ) = self.saved
+        fetch.sources.update(sources)
+        for directory in self.directories:
+            shutil.rmtree(directory)
+
+    def upstream(self, directory, days=n_days, lagging=None):
+        # the first days of the tables as upstream files in directory, only
+        # the first lagging ones for the lagging tables
+        os.makedirs(os.path.join(directory, "data"), exist_ok=True)
+        os.chdir(directory)
+        for name, df in self.tables.items():
+            columns = days if name not in (lagging or {}) else lagging[name]
+            path = os.path.join(directory, f"{name}.csv")
+            df.iloc[:, : 4 + columns].to_csv(path, index=False)
+            fetch.sources[names[name]] = path
+
+    def new_dates(self):
+        # what the next run would append
+        tables = {
+            name: pd.read_csv(fetch.sources[source])
+            for name, source in names.items()
+        }
+        state = process_worldwide.load_state()
+        return process_worldwide.find_new_dates(state, tables)
+
+    def run_in(self, directory, **kwargs):
+        # process_worldwide.py in directory, returns the state it left
+        self.upstream(directory, **kwargs)
+        process_worldwide.main()
+        return process_worldwide.load_state()
+
+    def directory(self):
+        directory = tempfile.mkdtemp()
+        self.directories.append(directory)
+        return directory
+
+    def assertSameOutputs(self, directory, expected):
+        for path in process_worldwide.output_files:
+            with open(os.path.join(directory, path)) as fp:
+                with open(os.path.join(expected, path)) as expected_fp:
+                    self.assertEqual(fp.read(), expected_fp.read(), path)
+
+    def rebuilt(self, **kwargs):
+        # the outputs of a run without a previous state
+        directory = self.directory()
+        self.run_in(directory, **kwargs)
+        return directory
+
+    def test_new_dates_are_appended(self):
+        directory = self.directory()
+        self.run_in(directory, days=n_days - 3)
+        with open(os.path.join(directory, aggregated)) as fp:
+            before = fp.read()
+        state = self.run_in(directory)
+        headers = synthetic.date_headers(n_days)
+        self.assertEqual(state["last_date"], headers[-1])
+        with open(os.path.join(directory, aggregated)) as fp:
+            self.assertTrue(fp.read().startswith(before))
+        self.assertSameOutputs(directory, self.rebuilt())
+
+    def test_revised_column_rebuilds(self):
+        directory = self.directory()
+        self.run_in(directory)
+        self.assertEqual(len(self.new_dates()), 0)
+        self.tables["confirmed"].iloc[0, 4 + 2] += 1
+        self.upstream(directory)
+        self.assertIsNone(self.new_dates())
+        self.run_in(directory)
+        self.assertSameOutputs(directory, self.rebuilt())
+
+    def test_lagging_table_holds_dates_back(self):
+        directory = self.directory()
+        self.run_in(directory, days=n_days - 3)
+        lagging = {"recovered": n_days - 2}
+        state = self.run_in(directory, lagging=lagging)
+        headers = synthetic.date_headers(n_days)
+        self.assertEqual(state["last_date"], headers[-3])
+        self.assertSameOutputs(directory, self.rebuilt(days=n_days - 2))
+        self.run_in(directory)
+        self.assertSameOutputs(directory, self.rebuilt())
+
+
+if __name__ == "__main__":
+    unittest.main()